@@ -1,31 +1,197 @@
 # app.py
 import os
-import re
 import json
+import asyncio
+import time
 import logging
-from typing import Optional, List, Dict, Any
+from enum import Enum
+from typing import Optional, List, Dict, Any, Tuple, Union
 from dotenv import load_dotenv
 load_dotenv()   
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, status
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from google import genai
 from google.genai import types
 
+from backends import GeminiBackend, LocalDetectorBackend, StubBackend, VisionBackend
+from batching import MicroBatcher
+from cache import ResultCache, PerceptualIndex, SingleFlight, sha256_hex
+from imaging import dhash, prepare_image, sniff_mime_type
+from metrics import (
+    LOAD_SHED, MICRO_BATCH_QUEUE_WAIT, MODEL_CALLS, MODEL_TOKENS, PARSE_FAILURES, UPSTREAM_ERRORS,
+    RequestMetricsMiddleware, ServerTimingMiddleware, register_stats, stage,
+)
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from resilience import (
+    AdaptiveLimiter, CircuitBreaker, CircuitOpenError, Hedger, OverloadedError, RetryPolicy,
+)
+from jobs import JobStore, JobWorkerPool
+from parsing import extract_first_json, extract_first_json_array
+from scheduler import Camera, CameraScheduler, load_cameras
+from streaming import FrameBuffer, ResultBroker
+from video import FrameSampler
+from uploads import BodySizeLimitMiddleware, MULTIPART_OVERHEAD_BYTES, read_upload
+
 # --- CONFIG ---
+VISION_BACKEND = os.getenv("VISION_BACKEND", "gemini").lower()  # "gemini", "local" (CPU detector) or "stub"
 API_KEY = os.getenv("GEMINI_API_KEY")  # set this in your deployment environment
-if not API_KEY:
+if VISION_BACKEND == "gemini" and not API_KEY:
     raise RuntimeError("Missing GEMINI_API_KEY environment variable")
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "800"))  # median simulated model latency
+STUB_LATENCY_SIGMA = float(os.getenv("STUB_LATENCY_SIGMA", "0.3"))  # log-normal spread; 0 = fixed latency
+STUB_ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))  # fraction of stub calls that fail
+STUB_RESPONSE_FILE = os.getenv("STUB_RESPONSE_FILE")  # optional canned JSON answer
+LOCAL_DETECTOR_MODEL = os.getenv("LOCAL_DETECTOR_MODEL")  # ONNX person detector (YOLO export)
+LOCAL_DETECTOR_ROLE = os.getenv("LOCAL_DETECTOR_ROLE", "off").lower()  # off, fallback or prefilter
+LOCAL_DETECTOR_SCORE_THRESHOLD = float(os.getenv("LOCAL_DETECTOR_SCORE_THRESHOLD", "0.35"))
+LOCAL_DETECTOR_THREADS = int(os.getenv("LOCAL_DETECTOR_THREADS", "0"))  # ONNX Runtime threads; 0 = all cores
+LOCAL_CROWD_CAPACITY = int(os.getenv("LOCAL_CROWD_CAPACITY", "80"))  # detected people that map to crowd_score 10
+LOCAL_PREFILTER_MAX_PEOPLE = int(os.getenv("LOCAL_PREFILTER_MAX_PEOPLE", "3"))  # prefilter answers at or below
+if LOCAL_DETECTOR_ROLE not in ("off", "fallback", "prefilter"):
+    raise RuntimeError(f"Unknown LOCAL_DETECTOR_ROLE: {LOCAL_DETECTOR_ROLE!r} (expected off, fallback or prefilter)")
+if (VISION_BACKEND == "local" or LOCAL_DETECTOR_ROLE != "off") and not LOCAL_DETECTOR_MODEL:
+    raise RuntimeError("Missing LOCAL_DETECTOR_MODEL environment variable")
 
 MAX_UPLOAD_BYTES = 5 * 1024 * 1024  # 5 MB - tune per your needs
 MODEL_NAME = "gemini-2.5-flash"      # change if you have another model
+MODEL_CONCURRENCY = int(os.getenv("MODEL_CONCURRENCY", "16"))  # max in-flight Gemini calls per process
+LIMITER_ADAPTIVE = os.getenv("LIMITER_ADAPTIVE", "true").lower() in ("1", "true", "yes")  # AIMD below the max
+LIMITER_MIN_CONCURRENCY = int(os.getenv("LIMITER_MIN_CONCURRENCY", "2"))
+LIMITER_LATENCY_TOLERANCE = float(os.getenv("LIMITER_LATENCY_TOLERANCE", "2.0"))  # x baseline before backing off
+LIMITER_MAX_QUEUE = int(os.getenv("LIMITER_MAX_QUEUE", "32"))  # waiting requests beyond the limit, then 503
+LIMITER_QUEUE_TIMEOUT_MS = float(os.getenv("LIMITER_QUEUE_TIMEOUT_MS", "2000"))  # max wait for a slot, then 503
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))  # send a duplicate after this latency percentile
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.05"))  # max extra calls as a fraction of all calls
+MODEL_ATTEMPT_TIMEOUT_S = float(os.getenv("MODEL_ATTEMPT_TIMEOUT_S", "30"))  # deadline per model call attempt
+MODEL_TOTAL_TIMEOUT_S = float(os.getenv("MODEL_TOTAL_TIMEOUT_S", "60"))  # deadline across all attempts
+MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", "2"))  # retries for retryable (transient) errors
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))  # retries earned per successful call
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))  # consecutive failures to open
+CIRCUIT_RESET_TIMEOUT_S = float(os.getenv("CIRCUIT_RESET_TIMEOUT_S", "30"))  # open period before a probe
+STALE_FALLBACK_MAX_AGE_S = float(os.getenv("STALE_FALLBACK_MAX_AGE_S", "600"))  # oldest last-known result served
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))  # 0 disables the cache
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "300"))  # 0 = never expire
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "4"))  # Hamming bits out of 64; negative disables
+PHASH_MAX_AGE_SECONDS = float(os.getenv("PHASH_MAX_AGE_SECONDS", "30"))  # oldest frame a near-duplicate may reuse
+PHASH_MAX_SOURCES = int(os.getenv("PHASH_MAX_SOURCES", "10000"))  # sources tracked; least recently used dropped
+PREPROCESS_ENABLED = os.getenv("PREPROCESS_ENABLED", "true").lower() in ("1", "true", "yes")
+PREPROCESS_MAX_SIDE = int(os.getenv("PREPROCESS_MAX_SIDE", "1536"))  # longest side in px sent to the model
+PREPROCESS_QUALITY = int(os.getenv("PREPROCESS_QUALITY", "85"))
+PREPROCESS_FORMAT = os.getenv("PREPROCESS_FORMAT", "JPEG")  # JPEG or WEBP
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "32"))  # max files accepted by /analyze-images
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "8"))  # images packed into one Gemini call
+MICROBATCH_ENABLED = os.getenv("MICROBATCH_ENABLED", "false").lower() in ("1", "true", "yes")
+MICROBATCH_MAX_SIZE = int(os.getenv("MICROBATCH_MAX_SIZE", "4"))  # single-image requests grouped per call
+MICROBATCH_WINDOW_MS = float(os.getenv("MICROBATCH_WINDOW_MS", "10"))  # max time a request waits for company
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "true").lower() in ("1", "true", "yes")  # JSON mode + schema
+MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "2048"))  # per image, when STRUCTURED_OUTPUT is on
+THINKING_BUDGET = int(os.getenv("THINKING_BUDGET", "0"))  # thinking tokens per call, on top of MAX_OUTPUT_TOKENS
+VIDEO_SAMPLE_FPS = float(os.getenv("VIDEO_SAMPLE_FPS", "1"))  # frames sampled per second of video
+VIDEO_SCENE_THRESHOLD = float(os.getenv("VIDEO_SCENE_THRESHOLD", "0.03"))  # min change (0-1) worth a model call
+VIDEO_MAX_FRAMES = int(os.getenv("VIDEO_MAX_FRAMES", "300"))  # analysed frames per video; 0 = no cap
+VIDEO_MAX_UPLOAD_BYTES = int(os.getenv("VIDEO_MAX_UPLOAD_BYTES", str(200 * 1024 * 1024)))
+VIDEO_CONCURRENCY = int(os.getenv("VIDEO_CONCURRENCY", "4"))  # frames of one video analysed at once
+WS_BACKPRESSURE = os.getenv("WS_BACKPRESSURE", "latest")  # "latest" (keep 1 frame) or "drop_oldest"
+WS_BUFFER_FRAMES = int(os.getenv("WS_BUFFER_FRAMES", "4"))  # frames buffered per connection with drop_oldest
+SSE_KEEPALIVE_S = float(os.getenv("SSE_KEEPALIVE_S", "15"))  # comment line sent on idle event streams
+SSE_SUBSCRIBER_BUFFER = int(os.getenv("SSE_SUBSCRIBER_BUFFER", "16"))  # unsent events kept per subscriber
+SSE_MAX_SUBSCRIBERS = int(os.getenv("SSE_MAX_SUBSCRIBERS", "10000"))  # open event streams per process, then 503
+CAMERAS_FILE = os.getenv("CAMERAS_FILE")  # JSON list of polled cameras; unset = no polling
+SCHEDULER_MODEL_CALLS_PER_MIN = float(os.getenv("SCHEDULER_MODEL_CALLS_PER_MIN", "60"))  # budget across all cameras
+SCHEDULER_MIN_INTERVAL_S = float(os.getenv("SCHEDULER_MIN_INTERVAL_S", "1"))  # fastest poll of a busy camera
+SCHEDULER_MAX_INTERVAL_S = float(os.getenv("SCHEDULER_MAX_INTERVAL_S", "60"))  # slowest poll of an idle camera
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.db")  # SQLite file backing POST /jobs
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "4"))  # jobs analysed concurrently per process
+JOBS_MAX_QUEUED = int(os.getenv("JOBS_MAX_QUEUED", "1000"))  # queued jobs beyond this are rejected with 503
+JOBS_RETENTION_S = float(os.getenv("JOBS_RETENTION_S", "86400"))  # finished jobs are deleted after this
+JOBS_LEASE_S = float(os.getenv("JOBS_LEASE_S", "60"))  # a running job whose worker stops renewing is retried after this
 
 # --- CLIENT SETUP ---
-client = genai.Client(api_key=API_KEY)
+# Local CPU person detector: the primary backend with VISION_BACKEND=local, else an optional helper
+local_detector = None
+if LOCAL_DETECTOR_MODEL and (VISION_BACKEND == "local" or LOCAL_DETECTOR_ROLE != "off"):
+    from detector import PersonDetector
+    local_detector = PersonDetector(LOCAL_DETECTOR_MODEL, score_threshold=LOCAL_DETECTOR_SCORE_THRESHOLD,
+                                    capacity=LOCAL_CROWD_CAPACITY, threads=LOCAL_DETECTOR_THREADS)
+
+
+def create_backend(name: str) -> VisionBackend:
+    if name == "gemini":
+        return GeminiBackend(api_key=API_KEY)
+    if name == "stub":
+        return StubBackend(latency_ms=STUB_LATENCY_MS, latency_sigma=STUB_LATENCY_SIGMA,
+                           error_rate=STUB_ERROR_RATE, response_file=STUB_RESPONSE_FILE)
+    if name == "local":
+        return LocalDetectorBackend(local_detector)
+    raise RuntimeError(f"Unknown VISION_BACKEND: {name!r} (expected 'gemini', 'local' or 'stub')")
+
+
+backend = create_backend(VISION_BACKEND)
+# "model" label on stage histograms and model metrics, and part of every result cache key, so local
+# answers are never mistaken for (or served as) Gemini ones
+MODEL_LABEL = backend.name if VISION_BACKEND == "local" else MODEL_NAME
+# Caps concurrent upstream calls; the cap adapts to observed model latency, and requests that
+# cannot get a slot quickly are shed with 503 instead of queueing without bound.
+model_limiter = AdaptiveLimiter(
+    initial_limit=MODEL_CONCURRENCY // 2 or 1, min_limit=LIMITER_MIN_CONCURRENCY, max_limit=MODEL_CONCURRENCY,
+    max_queue=LIMITER_MAX_QUEUE, queue_timeout=LIMITER_QUEUE_TIMEOUT_MS / 1000,
+    tolerance=LIMITER_LATENCY_TOLERANCE, adaptive=LIMITER_ADAPTIVE,
+)
+# Duplicates slow model calls (opt-in); the hedge shares the primary's limiter slot and is budgeted.
+hedger = Hedger(percentile=HEDGE_PERCENTILE, budget_ratio=HEDGE_BUDGET_RATIO)
+# Deadlines + jittered retries of transient failures, paid from a budget so retries cannot amplify an outage.
+retry_policy = RetryPolicy(
+    attempt_timeout=MODEL_ATTEMPT_TIMEOUT_S, total_timeout=MODEL_TOTAL_TIMEOUT_S, max_retries=MODEL_MAX_RETRIES,
+    budget_ratio=RETRY_BUDGET_RATIO, is_retryable=backend.is_retryable,
+)
+# Fails fast while the backend is down; recovery is probed with a single half-open call.
+circuit = CircuitBreaker(failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT_S)
+
+# --- RESULT CACHE ---
+# Keyed by image digest + model + prompt digest, so a prompt or model change never serves stale answers.
+result_cache = ResultCache(max_bytes=RESULT_CACHE_MAX_BYTES, ttl_seconds=RESULT_CACHE_TTL_SECONDS)
+# Near-duplicate frames from the same source (user_id) reuse a recent result, marked stale.
+phash_index = PerceptualIndex(max_distance=PHASH_MAX_DISTANCE, max_age_seconds=PHASH_MAX_AGE_SECONDS,
+                              max_sources=PHASH_MAX_SOURCES)
+# Last good result per source and mode, served (marked stale) on 503 when the client allows it.
+last_known = ResultCache(max_bytes=4 * 1024 * 1024, ttl_seconds=STALE_FALLBACK_MAX_AGE_S)
+# Identical uploads arriving together wait on one model call instead of each starting their own.
+inflight = SingleFlight()
+# Fresh results per source (user_id), fanned out to /events subscribers; one analysis serves every viewer.
+broker = ResultBroker(subscriber_buffer=SSE_SUBSCRIBER_BUFFER)
+# Running totals for the downscale/re-encode stage
+preprocess_stats = {"images": 0, "reencoded": 0, "bytes_in": 0, "bytes_out": 0, "ms_total": 0.0}
+# Multi-image model calls and how often their output had to be redone per image
+batch_stats = {"model_calls": 0, "images": 0, "fallbacks": 0}
+# Requests answered from last_known because the model was unavailable
+fallback_stats = {"served": 0, "unavailable": 0}
+# WebSocket stream connections and what happened to the frames they pushed
+ws_stats = {"connections_open": 0, "connections_total": 0, "frames_received": 0, "frames_dropped": 0,
+            "results_sent": 0}
+# Local detector used next to the remote model: frames it answered alone, passed on, or rescued
+local_stats = {"prefilter_answered": 0, "prefilter_passed": 0, "fallback_served": 0, "calls": 0, "ms_total": 0.0}
+# Per-mode model usage, to compare prompt sizes and latency across crowd/board/full
+mode_stats = {
+    mode: {"calls": 0, "images": 0, "failures": 0, "prompt_tokens": 0, "output_tokens": 0,
+           "total_tokens": 0, "latency_ms_total": 0.0}
+    for mode in ("crowd", "board", "full")
+}
 
 # --- FASTAPI SETUP ---
 app = FastAPI(title="CrowdDetector API", version="1.0")
+# Reject oversize bodies before the multipart parser reads them (Content-Length first, then a running count)
+app.add_middleware(BodySizeLimitMiddleware, limits={
+    "/analyze-image": MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+    "/analyze-images": BATCH_MAX_FILES * (MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES),
+    "/jobs": MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+    "/analyze-video": VIDEO_MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+})
+# Per-stage durations of each request, returned as a Server-Timing header
+app.add_middleware(ServerTimingMiddleware)
+# Outermost, so requests rejected by the inner middlewares are counted too
+app.add_middleware(RequestMetricsMiddleware)
 logger = logging.getLogger("uvicorn.error")
 
 
@@ -39,27 +205,159 @@ class CrowdResult(BaseModel):
     screen_detected: Optional[bool]       # Whether a screen/monitor/board was detected
     departure_type: Optional[str]         # e.g., "flight", "train", "bus", "none"
     departure_info: Optional[List[Dict[str, Any]]]  # List of departure entries with details
+    # Set when the result was reused from an earlier, visually near-identical frame
+    stale: bool = False
+    stale_age_seconds: Optional[float] = None
+    # Set when the local person detector answered instead of the vision model; board fields are then null
+    degraded: bool = False
+
 
+class DepartureEntry(BaseModel):
+    flight_number: Optional[str] = None
+    train_number: Optional[str] = None
+    route_number: Optional[str] = None
+    destination: Optional[str] = None
+    departure_time: Optional[str] = None
+    status: Optional[str] = None
+    gate: Optional[str] = None
+    platform: Optional[str] = None
 
-def extract_first_json(text: str):
+
+class CrowdResultOutput(BaseModel):
     """
-    Try to find a JSON object inside the response text.
-    Returns Python object or raises ValueError.
+    Response schema handed to Gemini in structured-output mode: the model-produced fields of
+    CrowdResult, with departure_info spelled out since the API cannot express free-form dicts.
     """
-    # Greedy-ish regex to capture the first balanced-looking JSON object
-    m = re.search(r"(\{[\s\S]*\})", text)
-    if not m:
-        raise ValueError("No JSON object found in model response")
-    candidate = m.group(1)
+    people_count: Optional[int]
+    crowd_score: Optional[int]
+    crowd_label: Optional[str]
+    confidence: Optional[float]
+    rationale: Optional[str]
+    screen_detected: Optional[bool]
+    departure_type: Optional[str]
+    departure_info: Optional[List[DepartureEntry]]
+
+
+class AnalysisMode(str, Enum):
+    crowd = "crowd"   # people counting only
+    board = "board"   # departure board reading only
+    full = "full"     # both (original behaviour)
+
+
+class CrowdOnlyResult(BaseModel):
+    people_count: Optional[int]
+    crowd_score: Optional[int]
+    crowd_label: Optional[str]
+    confidence: Optional[float]
+    rationale: Optional[str]
+    stale: bool = False
+    stale_age_seconds: Optional[float] = None
+    degraded: bool = False
+
+
+class BoardResult(BaseModel):
+    confidence: Optional[float]
+    rationale: Optional[str]
+    screen_detected: Optional[bool]
+    departure_type: Optional[str]
+    departure_info: Optional[List[Dict[str, Any]]]
+    stale: bool = False
+    stale_age_seconds: Optional[float] = None
+
+
+class CrowdOnlyOutput(BaseModel):
+    people_count: Optional[int]
+    crowd_score: Optional[int]
+    crowd_label: Optional[str]
+    confidence: Optional[float]
+    rationale: Optional[str]
+
+
+class BoardOutput(BaseModel):
+    confidence: Optional[float]
+    rationale: Optional[str]
+    screen_detected: Optional[bool]
+    departure_type: Optional[str]
+    departure_info: Optional[List[DepartureEntry]]
 
-    # Try progressive trimming in case of trailing commas or minor issues
-    try:
-        return json.loads(candidate)
-    except json.JSONDecodeError:
-        # attempt to strip trailing commas that often break JSON
-        cleaned = re.sub(r",\s*}", "}", candidate)
-        cleaned = re.sub(r",\s*]", "]", cleaned)
-        return json.loads(cleaned)
+
+# Fields returned to the client per mode (None = every CrowdResult field)
+MODE_FIELDS = {
+    AnalysisMode.crowd: set(CrowdOnlyResult.__fields__),
+    AnalysisMode.board: set(BoardResult.__fields__),
+    AnalysisMode.full: None,
+}
+MODE_OUTPUT_SCHEMAS = {
+    AnalysisMode.crowd: CrowdOnlyOutput,
+    AnalysisMode.board: BoardOutput,
+    AnalysisMode.full: CrowdResultOutput,
+}
+
+
+def render_result(result: CrowdResult, mode: AnalysisMode) -> Dict[str, Any]:
+    return result.dict(include=MODE_FIELDS[mode])
+
+
+def normalize_result(parsed: Dict[str, Any], local: bool = False) -> CrowdResult:
+    """
+    Coerce the model's parsed JSON into a CrowdResult, clamping and defaulting fields.
+    Raises on values that cannot be coerced. `local` marks an answer from the local person
+    detector: it never looked for a board, so the board fields are null (unknown), not "none".
+    """
+    people_count = parsed.get("people_count")
+    # try to coerce numeric types
+    if people_count is not None:
+        people_count = int(people_count)
+
+    crowd_score = parsed.get("crowd_score")
+    if crowd_score is not None:
+        crowd_score = int(crowd_score)
+        crowd_score = max(1, min(10, crowd_score))
+
+    crowd_label = parsed.get("crowd_label")
+    confidence = parsed.get("confidence")
+    if confidence is not None:
+        confidence = float(confidence)
+
+    rationale = parsed.get("rationale", "")
+
+    # Departure board fields
+    screen_detected = parsed.get("screen_detected")
+    if screen_detected is not None:
+        screen_detected = bool(screen_detected)
+    
+    departure_type = parsed.get("departure_type")
+    if departure_type and isinstance(departure_type, str):
+        departure_type = departure_type.lower()
+        valid_types = ["flight", "train", "bus", "subway", "ferry", "none"]
+        if departure_type not in valid_types:
+            departure_type = "none"
+    else:
+        departure_type = "none" if not screen_detected else None
+
+    departure_info = parsed.get("departure_info")
+    if departure_info is None:
+        departure_info = []
+    elif not isinstance(departure_info, list):
+        departure_info = []
+    else:
+        # Ensure each entry is a dict
+        departure_info = [entry for entry in departure_info if isinstance(entry, dict)]
+
+    if local:
+        screen_detected = departure_type = departure_info = None
+
+    return CrowdResult(
+        people_count=people_count,
+        crowd_score=crowd_score,
+        crowd_label=crowd_label,
+        confidence=confidence,
+        rationale=rationale,
+        screen_detected=screen_detected,
+        departure_type=departure_type,
+        departure_info=departure_info,
+        degraded=local,
+    )
 
 
 SYSTEM_PROMPT = """
@@ -90,110 +388,834 @@ If no screen/board is detected, set screen_detected to false, departure_type to
 Return the JSON object and nothing else.
 """
 
-@app.get("/health")
-def health():
-    return {"status": "ok"}
+CROWD_PROMPT = """
+You are a safety-first multimodal vision assistant. Analyze the provided image and return ONLY a JSON object (no surrounding explanation or markdown).
+
+Required fields:
+ - people_count: integer (estimated number of people visible in the image)
+ - crowd_score: integer 1-10 (1 = empty, 10 = extremely crowded)
+ - crowd_label: string ("Low", "Medium", or "High")
+ - confidence: float 0-100 (how confident you are about the count & score)
+ - rationale: short string (1 sentence) explaining how you derived the result
+
+If uncertain, set confidence lower and approximate the people_count as best as possible.
+Return the JSON object and nothing else.
+"""
 
+BOARD_PROMPT = """
+You are a multimodal vision assistant that reads departure boards. Analyze the provided image and return ONLY a JSON object (no surrounding explanation or markdown).
 
-@app.post("/analyze-image", response_model=CrowdResult)
-async def analyze_image(file: UploadFile = File(...), user_id: Optional[str] = None):
+Required fields:
+ - screen_detected: boolean (true if any screen, monitor, display board, or information board is visible in the image)
+ - departure_type: string (one of: "flight", "train", "bus", "subway", "ferry", or "none" if no departure board detected)
+ - departure_info: array of objects, one per visible departure, each with whichever of these are readable:
+   flight_number / train_number / route_number, destination, departure_time, status, gate / platform
+ - confidence: float 0-100 (how confident you are in what you read)
+ - rationale: short string (1 sentence)
+
+If no screen/board is detected, set screen_detected to false, departure_type to "none", and departure_info to an empty array.
+Return the JSON object and nothing else.
+"""
+
+MODE_PROMPTS = {
+    AnalysisMode.crowd: CROWD_PROMPT.strip(),
+    AnalysisMode.board: BOARD_PROMPT.strip(),
+    AnalysisMode.full: SYSTEM_PROMPT.strip(),
+}
+
+BATCH_PROMPT = """
+You will receive {count} images, each preceded by a label "Image 1", "Image 2", and so on.
+Analyze every image independently using the rules above.
+Instead of a single JSON object, return ONLY a JSON array with exactly {count} objects, one per image,
+in the same order as the images. Each object must contain all of the fields described above.
+"""
+MODE_PROMPT_HASHES = {mode: sha256_hex(prompt.encode("utf-8")) for mode, prompt in MODE_PROMPTS.items()}
+
+
+def result_cache_key(contents: bytes, mode: AnalysisMode = AnalysisMode.full, model: Optional[str] = None) -> str:
+    return f"{sha256_hex(contents)}:{model or MODEL_LABEL}:{MODE_PROMPT_HASHES[mode]}"
+
+
+async def build_image_part(contents: bytes, mime_type: str) -> types.Part:
     """
-    Accepts multipart/form-data with a single image file.
-    Returns a structured JSON with crowd analysis and departure board information (if detected).
-    Fields include: people_count, crowd_score, crowd_label, confidence, rationale,
-    screen_detected, departure_type, and departure_info.
+    Stage 2: downscale + re-encode off the event loop, then build the image PART for Gemini.
     """
-    # 1) Basic validations
-    contents = await file.read()
-    if not contents:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty file")
-    if len(contents) > MAX_UPLOAD_BYTES:
-        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-                            detail=f"File too large. Max {MAX_UPLOAD_BYTES} bytes allowed.")
+    if PREPROCESS_ENABLED:
+        try:
+            prepared = await asyncio.to_thread(
+                prepare_image, contents, mime_type, PREPROCESS_MAX_SIDE, PREPROCESS_QUALITY, PREPROCESS_FORMAT
+            )
+        except Exception as e:
+            logger.exception("Failed to preprocess image")
+            raise HTTPException(status_code=500, detail="Failed to prepare image for analysis")
+        preprocess_stats["images"] += 1
+        preprocess_stats["reencoded"] += int(prepared.reencoded)
+        preprocess_stats["bytes_in"] += prepared.original_bytes
+        preprocess_stats["bytes_out"] += len(prepared.data)
+        preprocess_stats["ms_total"] += prepared.elapsed_ms
+        logger.debug("Preprocessed image: %d -> %d bytes in %.1f ms",
+                     prepared.original_bytes, len(prepared.data), prepared.elapsed_ms)
+        contents, mime_type = prepared.data, prepared.mime_type
 
-    # 2) Build image PART for Gemini
     try:
-        image_part = types.Part.from_bytes(data=contents, mime_type=file.content_type or "image/jpeg")
+        return types.Part.from_bytes(data=contents, mime_type=mime_type)
     except Exception as e:
         logger.exception("Failed to create image part")
         raise HTTPException(status_code=500, detail="Failed to prepare image for analysis")
 
-    # 3) Prompt + call Gemini (synchronous)
-    prompt = SYSTEM_PROMPT.strip()
+
+def generation_config(mode: AnalysisMode, image_count: int = 1,
+                      batched: bool = False) -> Optional[types.GenerateContentConfig]:
+    """
+    Structured-output config: JSON MIME type plus a response schema, so the reply is bare JSON
+    with no prose to strip. None when STRUCTURED_OUTPUT is off (free-text prompt only).
+    Thinking tokens count against max_output_tokens, so the cap is raised by THINKING_BUDGET
+    (0 turns thinking off) and the JSON itself is never cut short.
+    """
+    if not STRUCTURED_OUTPUT:
+        return None
+    schema = MODE_OUTPUT_SCHEMAS[mode]
+    return types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=list[schema] if batched else schema,  # the SDK rejects typing.List
+        temperature=0.0,
+        max_output_tokens=MAX_OUTPUT_TOKENS * image_count + THINKING_BUDGET,
+        thinking_config=types.ThinkingConfig(thinking_budget=THINKING_BUDGET),
+    )
+
+
+def check_generation_configs() -> None:
+    """
+    Run every mode's single and batched response schema through the SDK's schema transformer,
+    which is what the Gemini client does on each call. A schema it cannot convert would otherwise
+    fail every request of that shape with a 502; this fails at startup instead. The transformer is
+    private to the SDK, so if an upgrade moves it the check is skipped with a warning.
+    """
     try:
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=[prompt, image_part],
-            # optionally set other params like temperature, max_output_tokens if SDK supports them:
-            # temperature=0.0, max_output_tokens=400
-        )
-        raw_text = response.text or ""
+        from google.genai._transformers import t_schema
+    except (ImportError, AttributeError) as e:
+        logger.warning("Skipping response schema check, SDK schema transformer unavailable: %s", e)
+        return
+
+    for mode in AnalysisMode:
+        for batched in (False, True):
+            config = generation_config(mode, 2 if batched else 1, batched=batched)
+            if config is None:
+                return
+            schema = t_schema(None, config.response_schema)
+            if schema.type is None or (batched and schema.items is None):
+                raise RuntimeError(f"Response schema for mode={mode.value} batched={batched} converts to {schema!r}")
+
+
+if VISION_BACKEND == "gemini":
+    check_generation_configs()
+
+
+async def generate_text(contents: List[Any], mode: AnalysisMode, image_count: int = 1,
+                        config: Optional[types.GenerateContentConfig] = None) -> str:
+    """
+    Stage 3: call the vision backend (async, so the event loop keeps serving other requests).
+    Token usage and latency are accumulated per analysis mode.
+    """
+    usage = mode_stats[mode.value]
+    try:
+        circuit.before_call()
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Vision model temporarily unavailable, retry later",
+                            headers={"Retry-After": str(e.retry_after)})
+    try:
+        with stage("queue", MODEL_LABEL):
+            await model_limiter.acquire()
+    except OverloadedError as e:
+        circuit.record(None)
+        LOAD_SHED.inc()
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Vision model is at capacity, retry later",
+                            headers={"Retry-After": str(e.retry_after)})
+    except BaseException:
+        circuit.record(None)
+        raise
+
+    started = time.perf_counter()
+    health = None  # what the call says about the backend; None for client errors such as a bad upload
+    try:
+        with stage("model", MODEL_LABEL):
+            if HEDGE_ENABLED:
+                response = await retry_policy.run(
+                    lambda: hedger.run(lambda: backend.generate(MODEL_NAME, contents, config))
+                )
+            else:
+                response = await retry_policy.run(lambda: backend.generate(MODEL_NAME, contents, config))
+        health = True
+        usage["latency_ms_total"] += (time.perf_counter() - started) * 1000
+    except asyncio.TimeoutError:
+        health = False
+        usage["failures"] += 1
+        MODEL_CALLS.labels(backend=backend.name, model=MODEL_LABEL, mode=mode.value, outcome="timeout").inc()
+        UPSTREAM_ERRORS.labels(reason="timeout").inc()
+        logger.error("Vision model call timed out (%s backend)", backend.name)
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="Vision model request timed out")
     except Exception as e:
-        logger.exception("Gemini API call failed")
+        health = False if backend.is_retryable(e) else None
+        usage["failures"] += 1
+        MODEL_CALLS.labels(backend=backend.name, model=MODEL_LABEL, mode=mode.value, outcome="error").inc()
+        UPSTREAM_ERRORS.labels(reason="model_call").inc()
+        logger.exception("Vision model call failed (%s backend)", backend.name)
         raise HTTPException(status_code=502, detail="Vision model request failed")
+    finally:
+        model_limiter.release(time.perf_counter() - started, health)
+        circuit.record(health)
+
+    usage["calls"] += 1
+    usage["images"] += image_count
+    usage["prompt_tokens"] += response.prompt_tokens
+    usage["output_tokens"] += response.output_tokens
+    usage["total_tokens"] += response.total_tokens
+    MODEL_CALLS.labels(backend=backend.name, model=MODEL_LABEL, mode=mode.value, outcome="ok").inc()
+    MODEL_TOKENS.labels(model=MODEL_LABEL, mode=mode.value, kind="prompt").inc(response.prompt_tokens)
+    MODEL_TOKENS.labels(model=MODEL_LABEL, mode=mode.value, kind="output").inc(response.output_tokens)
+    MODEL_TOKENS.labels(model=MODEL_LABEL, mode=mode.value, kind="total").inc(response.total_tokens)
+    return response.text
 
-    # 4) Extract JSON from response text robustly
+
+async def run_model_analysis(contents: bytes, mime_type: str, cache_key: str,
+                             mode: AnalysisMode = AnalysisMode.full) -> CrowdResult:
+    """
+    Stages 2-5 of the analysis: build the image part, call Gemini, parse and normalize.
+    Raises HTTPException on failure; stores successful results in the result cache.
+    """
+    # 2) Build image PART for Gemini
+    with stage("part", MODEL_LABEL):
+        image_part = await build_image_part(contents, mime_type)
+
+    # 3) Prompt + call Gemini
+    prompt = MODE_PROMPTS[mode]
+    raw_text = await generate_text([prompt, image_part], mode, config=generation_config(mode))
+
+    # 4) Extract JSON from response text robustly (in structured mode this is a direct parse)
     try:
-        parsed = extract_first_json(raw_text)
+        with stage("parse", MODEL_LABEL):
+            parsed = extract_first_json(raw_text)
     except Exception as e:
+        PARSE_FAILURES.labels(kind="single").inc()
+        UPSTREAM_ERRORS.labels(reason="parse").inc()
         logger.exception("Failed to parse JSON from model response", exc_info=e)
         # As a fallback, return a structured error payload that the frontend can handle
         raise HTTPException(status_code=502, detail="Model returned unexpected output format")
 
     # 5) Sanitize/normalize the parsed data into expected fields
     try:
-        people_count = parsed.get("people_count")
-        # try to coerce numeric types
-        if people_count is not None:
-            people_count = int(people_count)
-
-        crowd_score = parsed.get("crowd_score")
-        if crowd_score is not None:
-            crowd_score = int(crowd_score)
-            crowd_score = max(1, min(10, crowd_score))
-
-        crowd_label = parsed.get("crowd_label")
-        confidence = parsed.get("confidence")
-        if confidence is not None:
-            confidence = float(confidence)
-
-        rationale = parsed.get("rationale", "")
-
-        # Departure board fields
-        screen_detected = parsed.get("screen_detected")
-        if screen_detected is not None:
-            screen_detected = bool(screen_detected)
-        
-        departure_type = parsed.get("departure_type")
-        if departure_type and isinstance(departure_type, str):
-            departure_type = departure_type.lower()
-            valid_types = ["flight", "train", "bus", "subway", "ferry", "none"]
-            if departure_type not in valid_types:
-                departure_type = "none"
-        else:
-            departure_type = "none" if not screen_detected else None
-
-        departure_info = parsed.get("departure_info")
-        if departure_info is None:
-            departure_info = []
-        elif not isinstance(departure_info, list):
-            departure_info = []
-        else:
-            # Ensure each entry is a dict
-            departure_info = [entry for entry in departure_info if isinstance(entry, dict)]
-
-        result = CrowdResult(
-            people_count=people_count,
-            crowd_score=crowd_score,
-            crowd_label=crowd_label,
-            confidence=confidence,
-            rationale=rationale,
-            screen_detected=screen_detected,
-            departure_type=departure_type,
-            departure_info=departure_info
-        )
+        with stage("normalize", MODEL_LABEL):
+            result = normalize_result(parsed, local=VISION_BACKEND == "local")
     except Exception as e:
         logger.exception("Failed to normalize model JSON")
         raise HTTPException(status_code=500, detail="Failed to normalize model response")
 
-    return JSONResponse(status_code=200, content=result.dict())
+    result_cache.put(cache_key, result, len(result.json()))
+    return result
+
+
+async def run_batch_analysis(images: List[Tuple[bytes, str, str]],
+                             mode: AnalysisMode = AnalysisMode.full) -> List[CrowdResult]:
+    """
+    Analyze several (contents, mime_type, cache_key) images with a single Gemini call that
+    returns a JSON array. If the array does not parse or normalize cleanly, falls back to
+    one run_model_analysis call per image.
+    """
+    if len(images) == 1:
+        contents, mime_type, cache_key = images[0]
+        return [await run_model_analysis(contents, mime_type, cache_key, mode)]
+
+    with stage("part", MODEL_LABEL):
+        parts = await asyncio.gather(*(build_image_part(contents, mime_type) for contents, mime_type, _ in images))
+    request_contents: List[Any] = [MODE_PROMPTS[mode], BATCH_PROMPT.format(count=len(images)).strip()]
+    for i, part in enumerate(parts, start=1):
+        request_contents.extend([f"Image {i}:", part])
+    raw_text = await generate_text(request_contents, mode, len(images),
+                                   config=generation_config(mode, len(images), batched=True))
+
+    try:
+        with stage("parse", MODEL_LABEL):
+            parsed = extract_first_json_array(raw_text)
+        if len(parsed) != len(images):
+            raise ValueError(f"Expected {len(images)} results, got {len(parsed)}")
+        with stage("normalize", MODEL_LABEL):
+            results = [normalize_result(item, local=VISION_BACKEND == "local") for item in parsed]
+    except Exception as e:
+        PARSE_FAILURES.labels(kind="batch").inc()
+        logger.warning("Batched model output unusable (%s); falling back to per-image calls", e)
+        batch_stats["fallbacks"] += 1
+        return list(await asyncio.gather(
+            *(run_model_analysis(contents, mime_type, cache_key, mode) for contents, mime_type, cache_key in images)
+        ))
+
+    batch_stats["model_calls"] += 1
+    batch_stats["images"] += len(images)
+    for (_, _, cache_key), result in zip(images, results):
+        result_cache.put(cache_key, result, len(result.json()))
+    return results
+
+
+# Groups concurrent /analyze-image misses into multi-image calls when MICROBATCH_ENABLED is set.
+# One batcher per mode, since a single model call uses a single prompt.
+micro_batchers = {
+    mode: MicroBatcher(lambda items, mode=mode: run_batch_analysis(items, mode),
+                       max_batch_size=MICROBATCH_MAX_SIZE, max_wait_ms=MICROBATCH_WINDOW_MS,
+                       observe_wait=MICRO_BATCH_QUEUE_WAIT.labels(mode=mode.value).observe)
+    for mode in AnalysisMode
+}
+
+
+# --- ASYNC JOBS ---
+async def run_job(contents: bytes, params: Dict[str, Any]) -> Dict[str, Any]:
+    return await analyze_bytes(contents, params["mime_type"], params.get("user_id"),
+                               AnalysisMode(params["mode"]), params.get("allow_stale", False))
+
+
+# Queued images and results live in SQLite, so accepted jobs survive a restart. Claims are atomic and
+# leased, so several uvicorn workers can drain the same file: a job is retried only once the process
+# running it stopped renewing its lease. The file is opened in the startup hook.
+job_store = JobStore(JOBS_DB_PATH, lease_seconds=JOBS_LEASE_S)
+job_pool = JobWorkerPool(job_store, run_job, workers=JOBS_WORKERS, retention=JOBS_RETENTION_S)
+
+
+# --- CAMERA POLLING ---
+async def analyze_camera_frame(camera: Camera, contents: bytes) -> Dict[str, Any]:
+    # The camera id is the source id, so polled results feed /events/{id} and the stale fallback
+    return await analyze_bytes(contents, sniff_mime_type(contents), camera.id, AnalysisMode(camera.mode))
+
+
+cameras = load_cameras(CAMERAS_FILE, SCHEDULER_MIN_INTERVAL_S, SCHEDULER_MAX_INTERVAL_S) if CAMERAS_FILE else []
+if VISION_BACKEND == "local" and any(camera.mode == AnalysisMode.board.value for camera in cameras):
+    raise RuntimeError("Cameras with mode 'board' need a vision model; VISION_BACKEND=local only counts people")
+# Polls configured local sources itself; each new frame spends from a global model-call budget.
+camera_scheduler = CameraScheduler(cameras, analyze_camera_frame, calls_per_minute=SCHEDULER_MODEL_CALLS_PER_MIN)
+
+
+def _prometheus_stats() -> Dict[str, Any]:
+    cache = result_cache.stats()
+    near = phash_index.stats()
+    flight = inflight.stats()
+    batchers = [batcher.stats() for batcher in micro_batchers.values()]
+    return {
+        "crowd_result_cache_hits": ("counter", "Exact result cache hits", cache["hits"]),
+        "crowd_result_cache_misses": ("counter", "Exact result cache misses", cache["misses"]),
+        "crowd_result_cache_evictions": ("counter", "Exact result cache evictions", cache["evictions"]),
+        "crowd_result_cache_bytes": ("gauge", "Bytes held by the result cache", cache["bytes"]),
+        "crowd_near_duplicate_hits": ("counter", "Frames answered from a perceptually similar frame", near["hits"]),
+        "crowd_near_duplicate_misses": ("counter", "Frames with no recent similar frame", near["misses"]),
+        "crowd_single_flight_coalesced": ("counter", "Requests that joined an in-flight model call",
+                                          flight["coalesced"]),
+        "crowd_micro_batches": ("counter", "Micro-batches dispatched", sum(b["batches"] for b in batchers)),
+        "crowd_micro_batch_items": ("counter", "Requests dispatched via micro-batches",
+                                    sum(b["items"] for b in batchers)),
+        "crowd_model_concurrency_limit": ("gauge", "Current adaptive model concurrency limit",
+                                          model_limiter.stats()["limit"]),
+        "crowd_model_in_flight": ("gauge", "Model calls in flight", model_limiter.in_flight),
+        "crowd_model_queued": ("gauge", "Requests waiting for a model slot", model_limiter.stats()["queued"]),
+        "crowd_model_hedges": ("counter", "Duplicate model calls sent for slow requests", hedger.hedges),
+        "crowd_model_hedge_wins": ("counter", "Hedged calls that answered first", hedger.hedge_wins),
+        "crowd_model_hedge_budget_denied": ("counter", "Hedges skipped because the budget was spent",
+                                            hedger.budget_denied),
+        "crowd_model_attempts": ("counter", "Model call attempts including retries", retry_policy.attempts),
+        "crowd_model_retries": ("counter", "Model call retries", retry_policy.retries),
+        "crowd_model_attempt_timeouts": ("counter", "Model call attempts that hit their deadline",
+                                         retry_policy.timeouts),
+        "crowd_model_retry_budget_exhausted": ("counter", "Retries skipped because the budget was spent",
+                                               retry_policy.budget_exhausted),
+        "crowd_circuit_open": ("gauge", "1 while the model circuit breaker is open or half-open",
+                               int(circuit.state != CircuitBreaker.CLOSED)),
+        "crowd_circuit_opens": ("counter", "Times the model circuit breaker opened", circuit.opens),
+        "crowd_circuit_rejected": ("counter", "Calls failed fast by the open circuit", circuit.rejected),
+        "crowd_stale_fallbacks": ("counter", "503s answered with a last-known result instead",
+                                  fallback_stats["served"]),
+        # A gauge: re-encoding only to strip EXIF can grow an image, so the net saving may go down
+        "crowd_preprocess_bytes_saved": ("gauge", "Net upload bytes removed by downscale/re-encode",
+                                         preprocess_stats["bytes_in"] - preprocess_stats["bytes_out"]),
+        "crowd_ws_connections": ("gauge", "Open WebSocket stream connections", ws_stats["connections_open"]),
+        "crowd_ws_frames_received": ("counter", "Frames pushed over WebSocket streams", ws_stats["frames_received"]),
+        "crowd_ws_frames_dropped": ("counter", "Stream frames dropped by per-connection backpressure",
+                                    ws_stats["frames_dropped"]),
+        "crowd_sse_subscribers": ("gauge", "Open /events streams", broker.subscriber_count()),
+        "crowd_sse_events_delivered": ("counter", "Result events queued to /events subscribers", broker.delivered),
+        "crowd_sse_events_dropped": ("counter", "Result events dropped for slow /events subscribers",
+                                     broker.dropped),
+        "crowd_scheduler_frames_analyzed": ("counter", "Frames analysed by the camera poller",
+                                            camera_scheduler.stats()["analyzed"]),
+        "crowd_scheduler_deferred": ("counter", "Camera polls postponed because the model-call budget was spent",
+                                     camera_scheduler.deferred),
+        "crowd_local_prefilter_answered": ("counter", "Frames answered by the local detector without the model",
+                                           local_stats["prefilter_answered"]),
+        "crowd_local_fallback_served": ("counter", "Model failures answered by the local detector",
+                                        local_stats["fallback_served"]),
+        "crowd_jobs_completed": ("counter", "Async jobs finished successfully", job_pool.completed),
+        "crowd_jobs_failed": ("counter", "Async jobs finished with an error", job_pool.failed),
+    }
+
+
+register_stats(_prometheus_stats)
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "backend": backend.name}
+
+
+@app.get("/metrics")
+def metrics():
+    # Per-process: with several uvicorn workers, each scrape sees the worker that answered it
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/stats")
+def stats():
+    return {
+        "result_cache": result_cache.stats(),
+        "phash_index": phash_index.stats(),
+        "single_flight": inflight.stats(),
+        "model_limiter": model_limiter.stats(),
+        "hedging": {"enabled": HEDGE_ENABLED, **hedger.stats()},
+        "retries": retry_policy.stats(),
+        "circuit": circuit.stats(),
+        "stale_fallback": {**fallback_stats, "sources": last_known.stats()["entries"]},
+        "batch": batch_stats,
+        "micro_batch": {mode.value: batcher.stats() for mode, batcher in micro_batchers.items()},
+        "modes": {
+            mode: {
+                **usage,
+                "tokens_per_image": round(usage["total_tokens"] / usage["images"], 1) if usage["images"] else 0.0,
+                "latency_ms_avg": round(usage["latency_ms_total"] / usage["calls"], 1) if usage["calls"] else 0.0,
+            }
+            for mode, usage in mode_stats.items()
+        },
+        "preprocess": {
+            **preprocess_stats,
+            "bytes_saved": preprocess_stats["bytes_in"] - preprocess_stats["bytes_out"],
+        },
+        "local_detector": {
+            "role": "primary" if VISION_BACKEND == "local" else LOCAL_DETECTOR_ROLE,
+            **local_stats,
+            "latency_ms_avg": round(local_stats["ms_total"] / local_stats["calls"], 1) if local_stats["calls"] else 0.0,
+        },
+        "websocket": ws_stats,
+        "events": broker.stats(),
+        "scheduler": camera_scheduler.stats(),
+        "jobs": {**job_pool.stats(), "queued": job_store.count("queued"), "running": job_store.count("running")},
+    }
+
+
+def require_mode_supported(mode: AnalysisMode) -> None:
+    """The local detector only counts people, so with VISION_BACKEND=local board mode answers 501."""
+    if VISION_BACKEND == "local" and mode == AnalysisMode.board:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED,
+                            detail="mode=board needs a vision model; VISION_BACKEND=local only counts people")
+
+
+async def analyze_bytes(contents: bytes, mime_type: str, user_id: Optional[str] = None,
+                        mode: AnalysisMode = AnalysisMode.full, allow_stale: bool = False) -> Dict[str, Any]:
+    """
+    Shared analysis path for one image's bytes: exact cache, near-duplicate reuse per source,
+    coalesced (optionally micro-batched) model call and stale fallback. Returns the rendered result.
+    """
+    require_mode_supported(mode)
+    # Identical bytes under the same model + prompt always map to the same answer
+    cache_key = result_cache_key(contents, mode)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return render_result(cached, mode)
+
+    # Consecutive frames from a fixed camera differ in bytes but not in crowd; reuse a recent answer
+    phash = None
+    source_key = f"{user_id}:{mode.value}"
+    if user_id and PHASH_MAX_DISTANCE >= 0:
+        with stage("phash", MODEL_LABEL):
+            phash = await asyncio.to_thread(dhash, contents)
+        if phash is not None:
+            match = phash_index.lookup(source_key, phash)
+            if match is not None:
+                previous, age = match
+                reused = previous.copy(update={"stale": True, "stale_age_seconds": round(age, 3)})
+                return render_result(reused, mode)
+
+    # Easy frames (few or no people) are counted on CPU and never reach the remote model. Their answers
+    # are cached under the detector's label, so paths without the prefilter never serve them.
+    result = None
+    if LOCAL_DETECTOR_ROLE == "prefilter" and mode == AnalysisMode.crowd:
+        local_key = result_cache_key(contents, mode, model=LocalDetectorBackend.name)
+        result = result_cache.get(local_key)
+        if result is None:
+            local = await run_local_analysis(contents)
+            if local is not None and local.people_count <= LOCAL_PREFILTER_MAX_PEOPLE:
+                local_stats["prefilter_answered"] += 1
+                result_cache.put(local_key, local, len(local.json()))
+                result = local
+            else:
+                local_stats["prefilter_passed"] += 1
+
+    # 2-5) Model analysis; concurrent uploads of the same bytes share one in-flight call,
+    # and with micro-batching on, distinct concurrent uploads share one multi-image call.
+    # Only the request that made the call (the leader) publishes its result to /events subscribers.
+    leader = result is not None
+
+    async def call_model() -> CrowdResult:
+        nonlocal leader
+        leader = True
+        if MICROBATCH_ENABLED:
+            return await micro_batchers[mode].submit((contents, mime_type, cache_key))
+        return await run_model_analysis(contents, mime_type, cache_key, mode)
+
+    try:
+        if result is None:
+            result = await inflight.do(cache_key, call_model)
+    except HTTPException as e:
+        # A local count beats an error or a stale answer; it is not cached or reused for near-duplicates
+        if (LOCAL_DETECTOR_ROLE == "fallback" and mode != AnalysisMode.board
+                and e.status_code >= status.HTTP_500_INTERNAL_SERVER_ERROR):
+            local = await run_local_analysis(contents)
+            if local is not None:
+                local_stats["fallback_served"] += 1
+                rendered = render_result(local, mode)
+                if user_id and leader:
+                    publish_result(user_id, mode, rendered)
+                return rendered
+        if e.status_code != status.HTTP_503_SERVICE_UNAVAILABLE or not (allow_stale and user_id):
+            raise
+        fallback = last_known.get(source_key)
+        if fallback is None:
+            fallback_stats["unavailable"] += 1
+            raise
+        fallback_stats["served"] += 1
+        previous, stored_at = fallback
+        reused = previous.copy(update={"stale": True, "stale_age_seconds": round(time.monotonic() - stored_at, 3)})
+        return render_result(reused, mode)
+
+    if phash is not None:
+        phash_index.add(source_key, phash, result)
+    rendered = render_result(result, mode)
+    if user_id:
+        last_known.put(source_key, (result, time.monotonic()), len(result.json()))
+        if leader:
+            publish_result(user_id, mode, rendered)
+    return rendered
+
+
+async def run_local_analysis(contents: bytes) -> Optional[CrowdResult]:
+    """Crowd fields from the local CPU detector; None if the image could not be processed."""
+    started = time.perf_counter()
+    try:
+        with stage("local", LocalDetectorBackend.name):
+            fields = await asyncio.to_thread(local_detector.analyze, contents)
+    except Exception:
+        logger.exception("Local detector failed")
+        return None
+    finally:
+        local_stats["calls"] += 1
+        local_stats["ms_total"] += (time.perf_counter() - started) * 1000
+    return normalize_result(fields, local=True)
+
+
+def publish_result(source: str, mode: AnalysisMode, rendered: Dict[str, Any]) -> None:
+    """Send a fresh result to the source's event stream subscribers, encoded once for all of them."""
+    if not broker.has_subscribers(source):
+        return
+    event = {"source": source, "mode": mode.value, "ts": round(time.time(), 3), **rendered}
+    broker.publish(source, (mode, f"event: result\ndata: {json.dumps(event)}\n\n"))
+
+
+@app.post("/analyze-image", response_model=Union[CrowdResult, CrowdOnlyResult, BoardResult])
+async def analyze_image(file: UploadFile = File(...), user_id: Optional[str] = None,
+                        mode: AnalysisMode = AnalysisMode.full, allow_stale: bool = False):
+    """
+    Accepts multipart/form-data with a single image file.
+    Returns a structured JSON with crowd analysis and departure board information (if detected).
+    Fields include: people_count, crowd_score, crowd_label, confidence, rationale,
+    screen_detected, departure_type, and departure_info.
+    `mode=crowd` or `mode=board` sends a shorter prompt and returns only that half of the fields.
+    With `allow_stale=true` and a `user_id`, a 503 (model unavailable or at capacity) is answered
+    with the last known result for that source, marked stale, when one exists.
+    """
+    # 1) Basic validations (chunked read that stops at MAX_UPLOAD_BYTES)
+    with stage("read", MODEL_LABEL):
+        contents = await read_upload(file, MAX_UPLOAD_BYTES)
+    if not contents:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty file")
+
+    result = await analyze_bytes(contents, file.content_type or "image/jpeg", user_id, mode, allow_stale)
+    return JSONResponse(status_code=200, content=result)
+
+
+async def analyze_video(source: Any, mode: AnalysisMode = AnalysisMode.full, user_id: Optional[str] = None,
+                        sample_fps: Optional[float] = None, scene_threshold: Optional[float] = None,
+                        max_frames: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Decode a video (path or binary file) as a stream, sample it, drop frames that barely differ from
+    the last analysed one, and analyse the rest through analyze_bytes. Decoding runs in a thread and
+    stays at most VIDEO_CONCURRENCY frames ahead of the model calls.
+    Returns {"summary": ..., "rows": [...]}, one row per analysed frame in time order; a frame whose
+    analysis failed gets `error` and `status_code` instead of result fields.
+    """
+    require_mode_supported(mode)
+    started = time.perf_counter()
+    sampler = FrameSampler(
+        source,
+        sample_fps=VIDEO_SAMPLE_FPS if sample_fps is None else sample_fps,
+        scene_threshold=VIDEO_SCENE_THRESHOLD if scene_threshold is None else scene_threshold,
+        max_side=PREPROCESS_MAX_SIDE, quality=PREPROCESS_QUALITY,
+        max_frames=VIDEO_MAX_FRAMES if max_frames is None else max_frames,
+    )
+    slots = asyncio.Semaphore(max(1, VIDEO_CONCURRENCY))
+
+    async def analyze_frame(frame) -> Dict[str, Any]:
+        row = {"t": frame.timestamp, "frame": frame.index,
+               "scene_change": round(frame.difference, 4) if frame.difference is not None else None}
+        try:
+            row.update(await analyze_bytes(frame.data, "image/jpeg", user_id, mode))
+        except HTTPException as e:
+            row.update(error=e.detail, status_code=e.status_code)
+        finally:
+            slots.release()
+        return row
+
+    frames = sampler.frames()
+    tasks: List[asyncio.Task] = []
+    try:
+        while True:
+            await slots.acquire()
+            try:
+                with stage("decode", MODEL_LABEL):
+                    frame = await asyncio.to_thread(next, frames, None)
+            except ImportError:
+                raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED,
+                                    detail="Video input needs PyAV (pip install av)")
+            except Exception as e:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Could not decode video: {e}")
+            if frame is None:
+                slots.release()
+                break
+            tasks.append(asyncio.ensure_future(analyze_frame(frame)))
+        rows = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        await asyncio.to_thread(frames.close)
+
+    summary = {**sampler.stats(), "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+               "failed_frames": sum(1 for row in rows if "error" in row)}
+    return {"summary": summary, "rows": rows}
+
+
+@app.post("/analyze-video")
+async def analyze_video_upload(file: UploadFile = File(...), user_id: Optional[str] = None,
+                               mode: AnalysisMode = AnalysisMode.full, sample_fps: Optional[float] = None,
+                               scene_threshold: Optional[float] = None):
+    """
+    Accepts multipart/form-data with one video file (e.g. MP4) and returns a time series of
+    CrowdResult rows: `t` (seconds into the video), `frame`, `scene_change` and the result fields.
+    `sample_fps` and `scene_threshold` override VIDEO_SAMPLE_FPS and VIDEO_SCENE_THRESHOLD.
+    """
+    if sample_fps is not None and sample_fps <= 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="sample_fps must be positive")
+    if file.size == 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty file")
+    # Starlette has already spooled the upload to a temporary file; decode straight from it
+    report = await analyze_video(file.file, mode=mode, user_id=user_id, sample_fps=sample_fps,
+                                 scene_threshold=scene_threshold)
+    return JSONResponse(status_code=200, content=report)
+
+
+@app.websocket("/ws/analyze")
+async def analyze_stream(websocket: WebSocket, user_id: Optional[str] = None,
+                         mode: AnalysisMode = AnalysisMode.full, allow_stale: bool = False,
+                         backpressure: str = WS_BACKPRESSURE):
+    """
+    Continuous feed over one connection: the client sends each frame as a binary message and gets
+    one JSON message back per analysed frame, `{"seq": n, "dropped": d, ...result}`, where `seq`
+    numbers received frames from 1. Frames are analysed one at a time; frames arriving meanwhile
+    are buffered per `backpressure`: "latest" keeps only the newest, "drop_oldest" keeps up to
+    WS_BUFFER_FRAMES. Skipped frames are counted in `dropped` and never answered.
+    """
+    if backpressure not in ("latest", "drop_oldest"):
+        await websocket.close(code=1008, reason="backpressure must be 'latest' or 'drop_oldest'")
+        return
+    try:
+        require_mode_supported(mode)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    await websocket.accept()
+    buffer = FrameBuffer(1 if backpressure == "latest" else WS_BUFFER_FRAMES)
+    ws_stats["connections_open"] += 1
+    ws_stats["connections_total"] += 1
+
+    async def receive_frames():
+        seq = 0
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                seq += 1
+                ws_stats["frames_received"] += 1
+                data = message.get("bytes")
+                if data is None:
+                    error = {"error": "Frames must be sent as binary messages", "status_code": 400}
+                elif not data:
+                    error = {"error": "Empty frame", "status_code": 400}
+                elif len(data) > MAX_UPLOAD_BYTES:
+                    error = {"error": f"Frame too large. Max {MAX_UPLOAD_BYTES} bytes.", "status_code": 413}
+                else:
+                    error = None
+                dropped = buffer.dropped
+                buffer.put((seq, None if error else data, error))
+                ws_stats["frames_dropped"] += buffer.dropped - dropped
+        finally:
+            buffer.close()
+
+    receiver = asyncio.ensure_future(receive_frames())
+    try:
+        while True:
+            item = await buffer.get()
+            if item is None:
+                break
+            seq, data, error = item
+            if error is None:
+                try:
+                    result = await analyze_bytes(data, sniff_mime_type(data), user_id, mode, allow_stale)
+                except HTTPException as e:
+                    result = {"error": e.detail, "status_code": e.status_code}
+            else:
+                result = error
+            await websocket.send_json({"seq": seq, "dropped": buffer.dropped, **result})
+            ws_stats["results_sent"] += 1
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        ws_stats["connections_open"] -= 1
+
+
+@app.get("/events/{user_id}")
+async def result_events(user_id: str, mode: Optional[AnalysisMode] = None):
+    """
+    Server-Sent Events stream of every fresh result analysed for `user_id` (from /analyze-image,
+    /ws/analyze, /analyze-video or /jobs), as `event: result` messages carrying the result JSON plus
+    `source`, `mode` and `ts`. `mode` filters to one analysis mode. Near-duplicate reuse and stale
+    fallbacks are not published, since they repeat an earlier event.
+    """
+    if broker.subscriber_count() >= SSE_MAX_SUBSCRIBERS:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Too many event stream subscribers", headers={"Retry-After": "30"})
+    subscription = broker.subscribe(user_id)
+
+    async def stream():
+        try:
+            yield ": connected\n\n"
+            while True:
+                try:
+                    event_mode, event = await asyncio.wait_for(subscription.get(), SSE_KEEPALIVE_S)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"  # keeps proxies from closing an idle stream
+                    continue
+                if mode is None or event_mode == mode:
+                    yield event
+        finally:
+            broker.unsubscribe(user_id, subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/analyze-images", response_model=List[Union[CrowdResult, CrowdOnlyResult, BoardResult]])
+async def analyze_images(files: List[UploadFile] = File(...), mode: AnalysisMode = AnalysisMode.full):
+    """
+    Accepts multipart/form-data with several image files (repeat the `files` field).
+    Returns a JSON array of CrowdResult objects in upload order. Up to BATCH_SIZE uncached
+    images are packed into each Gemini call.
+    """
+    require_mode_supported(mode)
+    if len(files) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Too many files. Max {BATCH_MAX_FILES} per request.")
+
+    keys: List[str] = []
+    pending: Dict[str, Tuple[bytes, str, str]] = {}
+    results: Dict[str, CrowdResult] = {}
+    for file in files:
+        with stage("read", MODEL_LABEL):
+            contents = await read_upload(file, MAX_UPLOAD_BYTES)
+        if not contents:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Empty file: {file.filename}")
+        cache_key = result_cache_key(contents, mode)
+        keys.append(cache_key)
+        if cache_key in results or cache_key in pending:
+            continue  # same bytes uploaded twice in one request
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            results[cache_key] = cached
+        else:
+            pending[cache_key] = (contents, file.content_type or "image/jpeg", cache_key)
+
+    todo = list(pending.values())
+    chunks = [todo[i:i + BATCH_SIZE] for i in range(0, len(todo), max(1, BATCH_SIZE))]
+    for chunk, chunk_results in zip(chunks, await asyncio.gather(*(run_batch_analysis(c, mode) for c in chunks))):
+        for (_, _, cache_key), result in zip(chunk, chunk_results):
+            results[cache_key] = result
+
+    return JSONResponse(status_code=200, content=[render_result(results[key], mode) for key in keys])
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    await asyncio.to_thread(job_store.open)
+    job_pool.start()
+    camera_scheduler.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await camera_scheduler.stop()
+    await job_pool.stop()
+    job_store.close()
+
+
+@app.get("/cameras")
+def list_cameras():
+    """Polled cameras (CAMERAS_FILE) with their current interval, counters and latest result."""
+    return camera_scheduler.camera_stats()
+
+
+@app.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def create_job(file: UploadFile = File(...), user_id: Optional[str] = None,
+                     mode: AnalysisMode = AnalysisMode.full, allow_stale: bool = False):
+    """
+    Same input as /analyze-image, but returns a job id immediately instead of waiting for the model.
+    Poll GET /jobs/{job_id} for the result.
+    """
+    require_mode_supported(mode)
+    with stage("read", MODEL_LABEL):
+        contents = await read_upload(file, MAX_UPLOAD_BYTES)
+    if not contents:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty file")
+    if await asyncio.to_thread(job_store.count, "queued") >= JOBS_MAX_QUEUED:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Job queue is full",
+                            headers={"Retry-After": "30"})
+
+    params = {"mode": mode.value, "user_id": user_id, "mime_type": file.content_type or "image/jpeg",
+              "allow_stale": allow_stale}
+    job_id = await asyncio.to_thread(job_store.create, contents, params)
+    job_pool.notify()
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={"job_id": job_id, "status": "queued"},
+                        headers={"Location": f"/jobs/{job_id}"})
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Job status (queued, running, done, failed); `result` when done, `error` and `status_code` when failed."""
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown job id")
+    return job
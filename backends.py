@@ -0,0 +1,131 @@
+import json
+import random
+import asyncio
+import hashlib
+from dataclasses import dataclass
+from typing import Any, List, Optional
+
+
+@dataclass
+class ModelResponse:
+    text: str
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    total_tokens: int = 0
+
+
+class VisionBackend:
+    """
+    Interface for the model call. `contents` is the Gemini-style list of prompt strings and
+    image parts; `config` is a GenerateContentConfig or None.
+    """
+    name = "base"
+
+    async def generate(self, model: str, contents: List[Any], config: Optional[Any] = None) -> ModelResponse:
+        raise NotImplementedError
+
+    def is_retryable(self, error: BaseException) -> bool:
+        """Whether a failed call is worth retrying: timeouts and transport errors by default."""
+        return isinstance(error, (asyncio.TimeoutError, ConnectionError, OSError))
+
+
+class GeminiBackend(VisionBackend):
+    name = "gemini"
+
+    def __init__(self, api_key: str):
+        from google import genai
+        self.client = genai.Client(api_key=api_key)
+
+    async def generate(self, model: str, contents: List[Any], config: Optional[Any] = None) -> ModelResponse:
+        response = await self.client.aio.models.generate_content(model=model, contents=contents, config=config)
+        usage = getattr(response, "usage_metadata", None)
+        return ModelResponse(
+            text=response.text or "",
+            prompt_tokens=(usage.prompt_token_count or 0) if usage else 0,
+            output_tokens=(usage.candidates_token_count or 0) if usage else 0,
+            total_tokens=(usage.total_token_count or 0) if usage else 0,
+        )
+
+    def is_retryable(self, error: BaseException) -> bool:
+        import httpx
+        from google.genai import errors
+        if isinstance(error, errors.APIError):
+            return error.code == 429 or error.code >= 500  # rate limited or server-side
+        return isinstance(error, httpx.TransportError) or super().is_retryable(error)
+
+
+class StubBackend(VisionBackend):
+    """
+    Offline stand-in for load tests: sleeps for a log-normally distributed latency and answers
+    with deterministic JSON derived from each image's bytes (or a canned response file).
+    Multi-image calls get a JSON array, one element per image, like a batched Gemini reply.
+    """
+    name = "stub"
+
+    def __init__(self, latency_ms: float = 800, latency_sigma: float = 0.3, error_rate: float = 0.0,
+                 response_file: Optional[str] = None, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.canned = None
+        if response_file:
+            with open(response_file, "r", encoding="utf-8") as f:
+                self.canned = json.load(f)
+        self._random = random.Random(seed)
+
+    async def generate(self, model: str, contents: List[Any], config: Optional[Any] = None) -> ModelResponse:
+        if self.latency_ms > 0:
+            delay = self._random.lognormvariate(0, self.latency_sigma) * self.latency_ms / 1000
+            await asyncio.sleep(delay)
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise ConnectionError("Stub backend injected failure")  # looks like a transport error
+
+        images = [_image_bytes(part) for part in contents if not isinstance(part, str)]
+        answers = [self._answer(data) for data in images] or [self._answer(b"")]
+        text = json.dumps(answers if len(answers) > 1 else answers[0])
+        prompt_chars = sum(len(part) for part in contents if isinstance(part, str))
+        prompt_tokens = prompt_chars // 4 + 258 * len(images)  # Gemini bills ~258 tokens per small image
+        output_tokens = len(text) // 4
+        return ModelResponse(text, prompt_tokens, output_tokens, prompt_tokens + output_tokens)
+
+    def _answer(self, data: bytes) -> Any:
+        if self.canned is not None:
+            return self.canned
+        digest = hashlib.sha256(data).digest()
+        people = digest[0] % 80
+        score = max(1, min(10, people // 8 + 1))
+        return {
+            "people_count": people,
+            "crowd_score": score,
+            "crowd_label": "Low" if score <= 3 else "Medium" if score <= 6 else "High",
+            "confidence": 50 + digest[1] % 50,
+            "rationale": "Stub backend result derived from image bytes.",
+            "screen_detected": False,
+            "departure_type": "none",
+            "departure_info": [],
+        }
+
+
+class LocalDetectorBackend(VisionBackend):
+    """
+    Answers from a local CPU person detector (detector.PersonDetector) instead of a remote model.
+    Only the crowd fields are filled; board fields are left for normalisation to default.
+    Multi-image calls get a JSON array, like StubBackend.
+    """
+    name = "local"
+
+    def __init__(self, detector: Any):
+        self.detector = detector
+
+    async def generate(self, model: str, contents: List[Any], config: Optional[Any] = None) -> ModelResponse:
+        images = [_image_bytes(part) for part in contents if not isinstance(part, str)]
+        answers = [await asyncio.to_thread(self.detector.analyze, data) for data in images]
+        return ModelResponse(json.dumps(answers if len(answers) > 1 else answers[0]))
+
+    def is_retryable(self, error: BaseException) -> bool:
+        return False  # a deterministic local failure would fail again
+
+
+def _image_bytes(part: Any) -> bytes:
+    inline = getattr(part, "inline_data", None)
+    return getattr(inline, "data", None) or b""
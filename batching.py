@@ -0,0 +1,81 @@
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+class MicroBatcher:
+    """
+    Groups concurrent single-item submissions into batches.
+    A batch is dispatched when it reaches `max_batch_size` or when the oldest pending item has
+    waited `max_wait_ms`, whichever comes first. `handler` receives the list of items and must
+    return one result per item in the same order; an exception fails every caller in the batch.
+    `observe_wait`, if given, is called with each item's queue wait in seconds when it is dispatched
+    (e.g. a Prometheus histogram's observe).
+    """
+
+    def __init__(self, handler: Callable[[List[Any]], Awaitable[List[Any]]],
+                 max_batch_size: int, max_wait_ms: float,
+                 observe_wait: Optional[Callable[[float], None]] = None):
+        self.handler = handler
+        self.observe_wait = observe_wait
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self._pending: List[Tuple[Any, "asyncio.Future", float]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.batches = 0
+        self.items = 0
+        self.queue_wait_ms_total = 0.0
+        self.queue_wait_ms_max = 0.0
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future, time.perf_counter()))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        # Shielded so a disconnecting caller does not cancel the shared batch
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        now = time.perf_counter()
+        for _, _, queued_at in batch:
+            waited_ms = (now - queued_at) * 1000
+            self.queue_wait_ms_total += waited_ms
+            self.queue_wait_ms_max = max(self.queue_wait_ms_max, waited_ms)
+            if self.observe_wait is not None:
+                self.observe_wait(waited_ms / 1000)
+        self.batches += 1
+        self.items += len(batch)
+        asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: List[Tuple[Any, "asyncio.Future", float]]) -> None:
+        try:
+            results = await self.handler([item for item, _, _ in batch])
+        except BaseException as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "pending": len(self._pending),
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "queue_wait_ms_avg": round(self.queue_wait_ms_total / self.items, 3) if self.items else 0.0,
+            "queue_wait_ms_max": round(self.queue_wait_ms_max, 3),
+        }
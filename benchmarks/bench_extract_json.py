@@ -0,0 +1,119 @@
+"""
+Microbenchmark: balanced-scanner extract_first_json vs. the original regex implementation.
+
+    python benchmarks/bench_extract_json.py [--repeat 5] [--json]
+
+Each case is timed with timeit (best of --repeat). A case whose legacy run raises or returns
+the wrong object is reported as such, since correctness is half of the comparison.
+"""
+import os
+import re
+import sys
+import json
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parsing import extract_first_json  # noqa: E402
+
+
+def legacy_extract_first_json(text: str):
+    """The pre-scanner implementation, kept verbatim for comparison."""
+    m = re.search(r"(\{[\s\S]*\})", text)
+    if not m:
+        raise ValueError("No JSON object found in model response")
+    candidate = m.group(1)
+    try:
+        return json.loads(candidate)
+    except json.JSONDecodeError:
+        cleaned = re.sub(r",\s*}", "}", candidate)
+        cleaned = re.sub(r",\s*]", "]", cleaned)
+        return json.loads(cleaned)
+
+
+def _result(count: int, departures: int = 0) -> dict:
+    return {
+        "people_count": count,
+        "crowd_score": 5,
+        "crowd_label": "Medium",
+        "confidence": 80.0,
+        "rationale": "Counted heads near the gate {approximately}.",
+        "screen_detected": departures > 0,
+        "departure_type": "flight" if departures else "none",
+        "departure_info": [
+            {"flight_number": f"EK {700 + i}", "destination": "Dubai", "departure_time": "09:45",
+             "status": "Boarding", "gate": f"A{i}"}
+            for i in range(departures)
+        ],
+    }
+
+
+def build_cases():
+    small = _result(12)
+    large = _result(140, departures=400)
+    return [
+        ("small_clean", json.dumps(small), small),
+        ("small_fenced", "```json\n" + json.dumps(small, indent=2) + "\n```", small),
+        ("large_board", json.dumps(large), large),
+        ("prose_braces_after", json.dumps(small) + "\nNote: counts exclude staff {see policy}.", small),
+        ("trailing_comma", json.dumps(small)[:-1] + ",}", small),
+        ("prose_then_large", "Here is the analysis you asked for.\n" * 200 + json.dumps(large), large),
+        ("adversarial_open_braces", "{" * 20000, None),
+        ("adversarial_unclosed_string", '{"rationale": "' + "x" * 200000, None),
+        # Many small invalid spans before the answer: each one must cost O(span), not O(offset)
+        ("many_invalid_spans", "{x} " * 20000 + json.dumps(small), small),
+        ("many_invalid_keyed_spans", '{"note" see below} ' * 10000 + json.dumps(small), small),
+    ]
+
+
+def time_call(fn, text, repeat):
+    def run():
+        try:
+            fn(text)
+        except (ValueError, json.JSONDecodeError):
+            pass
+    number = 1
+    while timeit.timeit(run, number=number) < 0.05 and number < 100000:
+        number *= 10
+    return min(timeit.repeat(run, number=number, repeat=repeat)) / number * 1e6
+
+
+def outcome(fn, text, expected):
+    try:
+        got = fn(text)
+    except (ValueError, json.JSONDecodeError):
+        return "error" if expected is not None else "ok"
+    return "ok" if got == expected else "wrong"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="emit machine-readable JSON")
+    args = parser.parse_args()
+
+    rows = []
+    for name, text, expected in build_cases():
+        rows.append({
+            "case": name,
+            "input_chars": len(text),
+            "scanner_us": round(time_call(extract_first_json, text, args.repeat), 2),
+            "scanner_result": outcome(extract_first_json, text, expected),
+            "legacy_us": round(time_call(legacy_extract_first_json, text, args.repeat), 2),
+            "legacy_result": outcome(legacy_extract_first_json, text, expected),
+        })
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    header = f"{'case':<28}{'chars':>9}{'scanner us':>13}{'':>7}{'legacy us':>13}{'':>7}"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(f"{r['case']:<28}{r['input_chars']:>9}{r['scanner_us']:>13.2f}{r['scanner_result']:>7}"
+              f"{r['legacy_us']:>13.2f}{r['legacy_result']:>7}")
+
+
+if __name__ == "__main__":
+    main()
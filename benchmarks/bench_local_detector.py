@@ -0,0 +1,120 @@
+"""
+Local CPU person detector vs. the remote model: latency and agreement on the same images.
+
+    python benchmarks/bench_local_detector.py --images samples/ --model yolov8n.onnx [--limit 50] [--json]
+
+Every image is counted by the local detector (detector.PersonDetector) and analysed by the configured
+VISION_BACKEND in crowd mode (GEMINI_API_KEY from the environment / .env; the result cache is disabled,
+so every image reaches the model). Reported: per-path latency percentiles, and how often the local
+count matches the model's (mean absolute error, counts within max(2, 20%), same label, score within 1).
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["RESULT_CACHE_MAX_BYTES"] = "0"
+os.environ.setdefault("JOBS_DB_PATH", ":memory:")
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return round(sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo), 2)
+
+
+def latency_summary(values: List[float]) -> Dict:
+    ordered = sorted(values)
+    return {"p50": percentile(ordered, 50), "p95": percentile(ordered, 95), "max": percentile(ordered, 100)}
+
+
+async def run(paths: List[str], model_path: str, threshold: float, capacity: int) -> Dict:
+    import app
+    from detector import PersonDetector
+    from imaging import sniff_mime_type
+
+    detector = PersonDetector(model_path, score_threshold=threshold, capacity=capacity)
+    rows = []
+    for path in paths:
+        with open(path, "rb") as f:
+            contents = f.read()
+        started = time.perf_counter()
+        local = detector.analyze(contents)
+        local_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        try:
+            remote = (await app.run_model_analysis(contents, sniff_mime_type(contents),
+                                                   app.result_cache_key(contents, app.AnalysisMode.crowd),
+                                                   app.AnalysisMode.crowd)).dict()
+        except app.HTTPException as e:
+            remote = {"error": e.detail}
+        remote_ms = (time.perf_counter() - started) * 1000
+        rows.append({"image": os.path.basename(path), "local_ms": round(local_ms, 2), "remote_ms": round(remote_ms, 2),
+                     "local": {k: local[k] for k in ("people_count", "crowd_score", "crowd_label")},
+                     "remote": {k: remote.get(k) for k in ("people_count", "crowd_score", "crowd_label", "error")}})
+
+    compared = [r for r in rows if r["remote"]["people_count"] is not None]
+    errors = [abs(r["local"]["people_count"] - r["remote"]["people_count"]) for r in compared]
+
+    def rate(hits: int) -> Optional[float]:
+        return round(hits / len(compared), 3) if compared else None
+
+    return {
+        "config": {"model": model_path, "backend": app.backend.name, "score_threshold": threshold,
+                   "capacity": capacity, "images": len(rows), "compared": len(compared)},
+        "latency_ms": {
+            "local": latency_summary([r["local_ms"] for r in rows]),
+            "remote": latency_summary([r["remote_ms"] for r in rows]),
+        },
+        "agreement": {
+            "count_mae": round(sum(errors) / len(errors), 2) if errors else None,
+            "count_within_tolerance": rate(sum(
+                1 for r, e in zip(compared, errors) if e <= max(2, 0.2 * r["remote"]["people_count"]))),
+            "label_match": rate(sum(1 for r in compared if r["local"]["crowd_label"] == r["remote"]["crowd_label"])),
+            "score_within_1": rate(sum(
+                1 for r in compared
+                if r["remote"]["crowd_score"] is not None
+                and abs(r["local"]["crowd_score"] - r["remote"]["crowd_score"]) <= 1)),
+        },
+        "rows": rows,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", required=True, help="directory of test images")
+    parser.add_argument("--model", required=True, help="ONNX person detector (YOLO export)")
+    parser.add_argument("--threshold", type=float, default=0.35, help="detector score threshold")
+    parser.add_argument("--capacity", type=int, default=80, help="people that map to crowd_score 10")
+    parser.add_argument("--limit", type=int, default=0, help="max images (0 = all)")
+    parser.add_argument("--json", action="store_true", help="emit the full report as JSON")
+    args = parser.parse_args()
+
+    paths = sorted(os.path.join(args.images, name) for name in os.listdir(args.images)
+                   if name.lower().endswith(IMAGE_EXTENSIONS))
+    if args.limit:
+        paths = paths[:args.limit]
+    if not paths:
+        sys.exit(f"No images found in {args.images}")
+
+    report = asyncio.run(run(paths, args.model, args.threshold, args.capacity))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'path':<10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name, summary in report["latency_ms"].items():
+        print(f"{name:<10}{summary['p50']:>10}{summary['p95']:>10}{summary['max']:>10}")
+    print(json.dumps({**report["config"], **report["agreement"]}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
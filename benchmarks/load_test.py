@@ -0,0 +1,210 @@
+"""
+End-to-end load test for /analyze-image against a local uvicorn server using the stub backend.
+
+    python benchmarks/load_test.py --concurrency 1,8,32 --sizes 640,1920 --duration 10 --output results.json
+
+For every (image size, concurrency) pair, `concurrency` closed-loop clients post images for
+`--duration` seconds. Reported per run: p50/p95/p99/max latency, throughput, error rate and
+the RSS of each server process, as JSON. The result cache is disabled on the server unless
+--keep-cache is given, so every request exercises the full request path.
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+from PIL import Image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_images(longest_side: int, count: int, seed: int = 0) -> List[bytes]:
+    """Distinct noisy JPEGs (4:3), so uploads neither dedupe nor compress unrealistically well."""
+    rng = random.Random(seed)
+    width, height = longest_side, longest_side * 3 // 4
+    base = Image.effect_noise((width, height), 48).convert("RGB")
+    images = []
+    for _ in range(count):
+        img = base.copy()
+        img.putpixel((rng.randrange(width), rng.randrange(height)), (rng.randrange(256),) * 3)
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=90)
+        images.append(buf.getvalue())
+    return images
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def process_tree_rss(pid: int) -> Dict[int, int]:
+    """RSS in bytes of `pid` and its descendants (uvicorn workers), read from /proc."""
+    rss = {}
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss[current] = int(line.split()[1]) * 1024
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue  # process exited, or not on Linux
+    return rss
+
+
+def start_server(port: int, workers: int, env_overrides: Dict[str, str]) -> subprocess.Popen:
+    env = dict(os.environ, **env_overrides)
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=REPO_ROOT, env=env,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/health", timeout=1).ok:
+                return proc
+        except requests.RequestException:
+            pass
+        if proc.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("Server did not become healthy within 30s")
+
+
+def run_level(url: str, images: List[bytes], concurrency: int, duration: float, mode: str) -> Dict:
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client(worker: int):
+        session = requests.Session()
+        i = worker
+        while time.perf_counter() < stop_at:
+            payload = images[i % len(images)]
+            i += concurrency
+            started = time.perf_counter()
+            try:
+                r = session.post(url, params={"mode": mode},
+                                 files={"file": ("frame.jpg", payload, "image/jpeg")}, timeout=120)
+                key = str(r.status_code)
+            except requests.RequestException as e:
+                key = type(e).__name__
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with lock:
+                statuses[key] = statuses.get(key, 0) + 1
+                if key == "200":
+                    latencies.append(elapsed_ms)
+
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(client, range(concurrency)))
+    wall = time.perf_counter() - wall_started
+
+    total = sum(statuses.values())
+    ok = statuses.get("200", 0)
+    latencies.sort()
+    return {
+        "requests": total,
+        "status_counts": statuses,
+        "error_rate": round((total - ok) / total, 4) if total else None,
+        "throughput_rps": round(ok / wall, 2),
+        "latency_ms": {
+            "p50": _round(percentile(latencies, 50)),
+            "p95": _round(percentile(latencies, 95)),
+            "p99": _round(percentile(latencies, 99)),
+            "max": _round(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 2) if value is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", default="1,4,16,64", help="comma-separated client counts")
+    parser.add_argument("--sizes", default="640,1920", help="comma-separated longest image sides in px")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per (size, concurrency) run")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--mode", default="full", choices=["full", "crowd", "board"])
+    parser.add_argument("--stub-latency-ms", default="800")
+    parser.add_argument("--stub-latency-sigma", default="0.3")
+    parser.add_argument("--stub-error-rate", default="0")
+    parser.add_argument("--keep-cache", action="store_true", help="leave the server's result cache enabled")
+    parser.add_argument("--url", help="target an already running server instead of starting one")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    levels = [int(c) for c in args.concurrency.split(",")]
+    sizes = [int(s) for s in args.sizes.split(",")]
+    env = {
+        "VISION_BACKEND": "stub",
+        "STUB_LATENCY_MS": args.stub_latency_ms,
+        "STUB_LATENCY_SIGMA": args.stub_latency_sigma,
+        "STUB_ERROR_RATE": args.stub_error_rate,
+    }
+    if not args.keep_cache:
+        env["RESULT_CACHE_MAX_BYTES"] = "0"
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        port = free_port()
+        server = start_server(port, args.workers, env)
+        base_url = f"http://127.0.0.1:{port}"
+
+    report = {"config": {**vars(args), "server_env": env if server else None}, "runs": []}
+    try:
+        for size in sizes:
+            images = make_images(size, count=max(levels) * 2)
+            for level in levels:
+                run = run_level(f"{base_url}/analyze-image", images, level, args.duration, args.mode)
+                run.update({"image_side_px": size, "image_bytes_avg": sum(map(len, images)) // len(images),
+                            "concurrency": level})
+                if server is not None:
+                    run["rss_bytes_per_process"] = process_tree_rss(server.pid)
+                report["runs"].append(run)
+                print(f"size={size} concurrency={level} rps={run['throughput_rps']} "
+                      f"p50={run['latency_ms']['p50']} p99={run['latency_ms']['p99']} "
+                      f"errors={run['error_rate']}", file=sys.stderr)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from imaging import hamming_distance
+
+
+def sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache:
+    """
+    In-process LRU cache for analysis results, bounded by total payload size in bytes.
+    Entries expire after `ttl_seconds` (0 disables expiry).
+    Values are stored together with their size so eviction is O(1) per entry.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float = 0):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[Any, int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, stored_at = entry
+            if self.ttl_seconds and time.monotonic() - stored_at > self.ttl_seconds:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Any, size: int) -> None:
+        if size > self.max_bytes:
+            return  # would evict everything else and still not fit
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic())
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class PerceptualIndex:
+    """
+    Per-source window of recent (perceptual hash, result) pairs.
+    A new frame whose hash is within `max_distance` bits of a recent frame from the same
+    source reuses that frame's result instead of calling the model again.
+    Sources are kept in LRU order and capped at `max_sources`; entries older than
+    `max_age_seconds` are dropped, and a source whose window empties is forgotten.
+    """
+
+    def __init__(self, max_distance: int, max_age_seconds: float, history: int = 8, max_sources: int = 10000):
+        self.max_distance = max_distance
+        self.max_age_seconds = max_age_seconds
+        self.history = history
+        self.max_sources = max(1, max_sources)
+        self._recent: "OrderedDict[str, deque[Tuple[int, Any, float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, source: str, phash: int) -> Optional[Tuple[Any, float]]:
+        """Returns (result, age_seconds) of the closest recent match, or None."""
+        now = time.monotonic()
+        with self._lock:
+            window = self._prune(source, now)
+            best = None
+            best_distance = self.max_distance + 1
+            if window:
+                self._recent.move_to_end(source)
+                for other, value, stored_at in window:
+                    distance = hamming_distance(phash, other)
+                    if distance < best_distance:
+                        best, best_distance = (value, now - stored_at), distance
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return best
+
+    def add(self, source: str, phash: int, value: Any) -> None:
+        now = time.monotonic()
+        with self._lock:
+            window = self._recent.get(source)
+            if window is None:
+                window = self._recent[source] = deque(maxlen=self.history)
+            self._recent.move_to_end(source)
+            window.append((phash, value, now))
+            # Least recently used first: drop expired windows, then any excess over max_sources
+            while self._recent:
+                oldest = next(iter(self._recent))
+                if len(self._recent) > self.max_sources or self._prune(oldest, now) is None:
+                    if oldest in self._recent:
+                        del self._recent[oldest]
+                        self.evictions += 1
+                    continue
+                break
+
+    def _prune(self, source: str, now: float) -> "Optional[deque[Tuple[int, Any, float]]]":
+        """Drop the source's expired entries (oldest first); forget the source once none are left."""
+        window = self._recent.get(source)
+        if window is None:
+            return None
+        while window and now - window[0][2] > self.max_age_seconds:
+            window.popleft()
+        if not window:
+            del self._recent[source]
+            return None
+        return window
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sources": len(self._recent),
+                "max_sources": self.max_sources,
+                "max_distance": self.max_distance,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller starts the work,
+    later callers with the same key await the same task and receive its result or exception.
+    The task is shielded, so one caller disconnecting does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, "asyncio.Task"] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,105 @@
+import io
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+DHASH_SIZE = 8  # 8x8 gradient grid -> 64-bit hash
+
+
+def dhash(contents: bytes, hash_size: int = DHASH_SIZE) -> Optional[int]:
+    """
+    Difference hash of an encoded image: grayscale, shrink to (hash_size+1) x hash_size,
+    then one bit per horizontally adjacent pixel pair. Returns None if the bytes do not decode.
+    CPU-bound; call it off the event loop.
+    """
+    try:
+        with Image.open(io.BytesIO(contents)) as img:
+            img.draft("L", (hash_size * 16, hash_size * 16))  # lets JPEG decode at reduced scale
+            small = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    except Exception:
+        return None
+    pixels = small.tobytes()
+    value = 0
+    width = hash_size + 1
+    for row in range(hash_size):
+        offset = row * width
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def sniff_mime_type(contents: bytes, default: str = "image/jpeg") -> str:
+    """MIME type from the leading magic bytes, for image bytes that arrive without a Content-Type."""
+    if contents.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if contents.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if contents[:4] == b"RIFF" and contents[8:12] == b"WEBP":
+        return "image/webp"
+    if contents[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return default
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime_type: str
+    original_bytes: int
+    elapsed_ms: float
+    reencoded: bool
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_bytes - len(self.data)
+
+
+_ENCODERS = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+
+def prepare_image(contents: bytes, mime_type: str, max_side: int, quality: int, fmt: str = "JPEG") -> PreparedImage:
+    """
+    Decode, apply EXIF orientation, downscale so the longest side is at most `max_side`,
+    and re-encode without metadata. Falls back to the original bytes when the upload does not
+    decode, or when the re-encoded image would not be smaller and the original carries no EXIF
+    or XMP (which may hold GPS position) to strip. CPU-bound; call it off the event loop.
+    """
+    started = time.perf_counter()
+    fmt = fmt.upper()
+    out_mime = _ENCODERS.get(fmt)
+    if out_mime is None:
+        raise ValueError(f"Unsupported output format: {fmt}")
+
+    def _unchanged() -> PreparedImage:
+        elapsed = (time.perf_counter() - started) * 1000
+        return PreparedImage(contents, mime_type, len(contents), elapsed, False)
+
+    try:
+        with Image.open(io.BytesIO(contents)) as img:
+            if max_side > 0:
+                img.draft("RGB", (max_side, max_side))  # JPEG: decode directly at a reduced scale
+            has_metadata = bool(img.getexif()) or "xmp" in img.info or "XML:com.adobe.xmp" in img.info
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            if max_side > 0 and max(img.size) > max_side:
+                img.thumbnail((max_side, max_side), Image.LANCZOS)
+            buf = io.BytesIO()
+            img.save(buf, format=fmt, quality=quality)  # no exif= argument, so metadata is dropped
+    except Exception:
+        return _unchanged()
+
+    data = buf.getvalue()
+    if len(data) >= len(contents) and not has_metadata:
+        return _unchanged()
+    elapsed = (time.perf_counter() - started) * 1000
+    return PreparedImage(data, out_mime, len(contents), elapsed, True)
@@ -0,0 +1,268 @@
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger("uvicorn.error")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,            -- queued | running | done | failed
+    params TEXT NOT NULL,            -- JSON: mode, user_id, mime_type, ...
+    image BLOB,                      -- dropped once the job finishes
+    result TEXT,                     -- JSON result when done
+    error TEXT,
+    status_code INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    claimed_by TEXT,                 -- JobStore.owner of the store running the job
+    lease_until REAL                 -- a running job whose lease has passed is claimed again
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+
+class JobStore:
+    """
+    SQLite-backed job queue that several processes can share. A claimed job is leased to this
+    store (`owner`) for `lease_seconds` and the lease is renewed while the job runs, so a job left
+    `running` by a crashed or killed process is claimed again once its lease expires, while jobs
+    other live processes are running are left alone. The file is not touched until open().
+    Methods are blocking; call them via asyncio.to_thread.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 60.0):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.owner = uuid.uuid4().hex
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def open(self) -> None:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        with self._lock:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            conn.execute("BEGIN IMMEDIATE")  # another process may be migrating the same file
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (("claimed_by", "TEXT"), ("lease_until", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")  # file from before leases
+            conn.execute("COMMIT")
+            self._conn = conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def create(self, image: bytes, params: Dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, params, image, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, json.dumps(params), image, now, now),
+            )
+        return job_id
+
+    def claim_next(self) -> Optional[Dict[str, Any]]:
+        """
+        Atomically lease the oldest job that is queued, or running under an expired lease, and
+        return it (with its image).
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id, status, params, image FROM jobs WHERE status IN ('queued', 'running') "
+                    "AND (status = 'queued' OR COALESCE(lease_until, 0) < ?) ORDER BY created_at LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', claimed_by = ?, lease_until = ?, updated_at = ? "
+                        "WHERE id = ?",
+                        (self.owner, now + self.lease_seconds, now, row["id"]),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        if row["status"] == "running":
+            logger.info("Reclaimed job %s after its lease expired", row["id"])
+        return {"id": row["id"], "params": json.loads(row["params"]), "image": row["image"]}
+
+    def renew(self, job_ids: List[str]) -> int:
+        """Extend the leases of these jobs, if this store still holds them; returns how many were renewed."""
+        placeholders = ", ".join("?" * len(job_ids))
+        with self._lock:
+            return self._conn.execute(
+                f"UPDATE jobs SET lease_until = ? WHERE claimed_by = ? AND status = 'running' AND id IN ({placeholders})",
+                (time.time() + self.lease_seconds, self.owner, *job_ids),
+            ).rowcount
+
+    def release(self, job_id: str) -> None:
+        """Put a job this store claimed but will not finish back in the queue."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', claimed_by = NULL, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND claimed_by = ? AND status = 'running'",
+                (time.time(), job_id, self.owner),
+            )
+
+    def finish(self, job_id: str, result: Optional[Dict[str, Any]] = None,
+               error: Optional[str] = None, status_code: int = 200) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, status_code = ?, image = NULL, "
+                "lease_until = NULL, updated_at = ? WHERE id = ?",
+                ("done" if error is None else "failed", json.dumps(result) if result is not None else None,
+                 error, status_code, time.time(), job_id),
+            )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, params, result, error, status_code, created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job = {
+            "job_id": row["id"],
+            "status": row["status"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+        if row["status"] == "done":
+            job["result"] = json.loads(row["result"])
+        elif row["status"] == "failed":
+            job["error"] = row["error"]
+            job["status_code"] = row["status_code"]
+        return job
+
+    def count(self, status: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def purge(self, older_than: float) -> int:
+        """Delete finished jobs last updated before `older_than` (epoch seconds)."""
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (older_than,)
+            ).rowcount
+
+
+class JobWorkerPool:
+    """
+    `workers` asyncio tasks draining a JobStore. `handler(image, params)` returns the JSON result;
+    an exception with a `status_code` attribute (e.g. HTTPException) is recorded with that code.
+    Workers sleep until `notify()` or `poll_interval`, so new jobs start without busy polling.
+    One more task renews the leases of the jobs being run every third of `store.lease_seconds`.
+    A store error (e.g. "database is locked") is logged and the worker retries after `poll_interval`.
+    """
+
+    def __init__(self, store: JobStore, handler: Callable[[bytes, Dict[str, Any]], Awaitable[Dict[str, Any]]],
+                 workers: int, poll_interval: float = 1.0, retention: float = 86400):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running: set = set()
+        self.completed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.ensure_future(self._renew_leases()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _worker(self) -> None:
+        last_purge = 0.0
+        while True:
+            try:
+                self._wakeup.clear()  # before claiming, so a notify() during the claim is not lost
+                job = await asyncio.to_thread(self.store.claim_next)
+                if job is None:
+                    if time.time() - last_purge > 3600:
+                        last_purge = time.time()
+                        await asyncio.to_thread(self.store.purge, last_purge - self.retention)
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._run(job)
+            except Exception:
+                # e.g. "database is locked" while other processes hold the file; the worker must survive
+                logger.exception("Job worker iteration failed")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _renew_leases(self) -> None:
+        while True:
+            await asyncio.sleep(self.store.lease_seconds / 3)
+            if not self._running:
+                continue
+            try:
+                await asyncio.to_thread(self.store.renew, list(self._running))
+            except Exception:
+                logger.exception("Renewing job leases failed")
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        # Only jobs in here have their lease renewed: one whose finish() failed is retried elsewhere
+        self._running.add(job["id"])
+        try:
+            await self._handle(job)
+        finally:
+            self._running.discard(job["id"])
+
+    async def _handle(self, job: Dict[str, Any]) -> None:
+        try:
+            result = await self.handler(job["image"], job["params"])
+        except asyncio.CancelledError:
+            try:
+                self.store.release(job["id"])  # shutting down; let another worker have it right away
+            except Exception:
+                logger.exception("Releasing job %s failed; it is retried when its lease expires", job["id"])
+            raise
+        except Exception as e:
+            self.failed += 1
+            code = getattr(e, "status_code", 500)
+            detail = getattr(e, "detail", None) or str(e) or type(e).__name__
+            if code == 500:
+                logger.exception("Job %s failed", job["id"])
+            await asyncio.to_thread(self.store.finish, job["id"], error=str(detail), status_code=code)
+            return
+        self.completed += 1
+        await asyncio.to_thread(self.store.finish, job["id"], result=result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
@@ -0,0 +1,180 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "crowd_stage_duration_seconds",
+    "Time spent in each analysis stage",
+    ["stage", "model", "outcome"],
+    buckets=STAGE_BUCKETS,
+)
+
+HTTP_REQUESTS = Counter(
+    "crowd_http_requests_total",
+    "HTTP requests by route and status code",
+    ["path", "status"],
+)
+HTTP_IN_FLIGHT = Gauge(
+    "crowd_http_requests_in_flight",
+    "HTTP requests currently being served",
+)
+HTTP_BYTES_RECEIVED = Counter(
+    "crowd_http_request_bytes_received_total",
+    "Request body bytes received, by route",
+    ["path"],
+)
+MODEL_CALLS = Counter(
+    "crowd_model_calls_total",
+    "Calls to the vision model backend",
+    ["backend", "model", "mode", "outcome"],
+)
+MODEL_TOKENS = Counter(
+    "crowd_model_tokens_total",
+    "Tokens reported by the model backend",
+    ["model", "mode", "kind"],
+)
+PARSE_FAILURES = Counter(
+    "crowd_parse_failures_total",
+    "Model responses that did not yield usable JSON",
+    ["kind"],
+)
+UPSTREAM_ERRORS = Counter(
+    "crowd_upstream_errors_total",
+    "Requests failed because of the model, by reason (timeout = 504, model_call and parse = 502)",
+    ["reason"],
+)
+MICRO_BATCH_QUEUE_WAIT = Histogram(
+    "crowd_micro_batch_queue_wait_seconds",
+    "Time a request waited in the micro-batch queue before its batch was dispatched, by mode",
+    ["mode"],
+    buckets=STAGE_BUCKETS,
+)
+LOAD_SHED = Counter(
+    "crowd_load_shed_total",
+    "Requests rejected with 503 because the model concurrency limit and queue were full",
+)
+
+# Stage durations (ms) of the request being served; set per request by ServerTimingMiddleware.
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def stage(name: str, model: str) -> Iterator[None]:
+    """
+    Time a block as analysis stage `name`: observed in the Prometheus histogram (outcome ok/error)
+    and added to the current request's Server-Timing header. Repeated stages accumulate.
+    """
+    outcome = "ok"
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage=name, model=model, outcome=outcome).observe(elapsed)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed * 1000
+
+
+class ServerTimingMiddleware:
+    """
+    ASGI middleware that collects the stage timings recorded during a request and returns them
+    as a `Server-Timing` response header, e.g. `read;dur=1.2, model;dur=812.4`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings: Dict[str, float] = {}
+        token = _request_timings.set(timings)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and timings:
+                value = ", ".join(f"{name};dur={ms:.2f}" for name, ms in timings.items())
+                message = dict(message, headers=list(message.get("headers", [])) + [
+                    (b"server-timing", value.encode("latin-1")),
+                ])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware counting requests by route template and status, the in-flight gauge,
+    and request body bytes received.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+        received = 0
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def capturing_send(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, counting_receive, capturing_send)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            # Route template, so ids do not explode label cardinality. Requests rejected before
+            # routing (e.g. 413 from the body limit) keep their raw path; unknown paths collapse.
+            route = scope.get("route")
+            path = getattr(route, "path", None)
+            if path is None:
+                path = "unmatched" if status_code == 404 else scope["path"]
+            HTTP_REQUESTS.labels(path=path, status=str(status_code)).inc()
+            if received:
+                HTTP_BYTES_RECEIVED.labels(path=path).inc(received)
+
+
+class StatsCollector:
+    """
+    Exposes in-process counters kept as plain dicts/attributes (cache, single-flight, batching)
+    at scrape time, so those classes stay free of Prometheus imports.
+    `source` returns {metric_name: (kind, help, value)} with kind "counter" or "gauge".
+    """
+
+    def __init__(self, source: Callable[[], Dict[str, Any]]):
+        self.source = source
+
+    def collect(self) -> Iterable[Any]:
+        for name, (kind, help_text, value) in self.source().items():
+            family = CounterMetricFamily if kind == "counter" else GaugeMetricFamily
+            yield family(name, help_text, value=value)
+
+
+def register_stats(source: Callable[[], Dict[str, Any]]) -> None:
+    REGISTRY.register(StatsCollector(source))
@@ -0,0 +1,140 @@
+import re
+import json
+from typing import Any, Callable, Dict, List, Optional
+
+_TRAILING_COMMA_OBJ = re.compile(r",\s*}")
+_TRAILING_COMMA_ARR = re.compile(r",\s*]")
+_JSON_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+_STRUCTURAL = {
+    "{": re.compile(r'[{}"]'),
+    "[": re.compile(r'[\[\]"]'),
+}
+_OBJECT_START = re.compile(r'\{\s*["}]')  # how any JSON object opens: a key or an immediate close
+_decoder = json.JSONDecoder()
+# Unclosed opening brackets tolerated before giving up. Each one costs a scan to the end of the
+# text, so the cap keeps adversarial input (many stray brackets) linear.
+MAX_UNCLOSED = 8
+
+
+def _balanced_end(text: str, start: int, open_char: str, close_char: str) -> int:
+    """
+    Index just past the bracket that closes the one at `start`, or -1 if it never closes.
+    Brackets inside JSON string literals do not count. The regexes jump between structural
+    characters and over whole string literals, so the per-character work stays in C.
+    """
+    structural = _STRUCTURAL[open_char]
+    depth = 1
+    pos = start + 1
+    while depth:
+        m = structural.search(text, pos)
+        if m is None:
+            return -1
+        ch = m.group()
+        if ch == '"':
+            literal = _JSON_STRING.match(text, m.start())
+            if literal is None:
+                return -1  # unterminated string literal
+            pos = literal.end()
+            continue
+        depth += 1 if ch == open_char else -1
+        pos = m.end()
+    return pos
+
+
+def _strip_trailing_commas(candidate: str) -> str:
+    cleaned = _TRAILING_COMMA_OBJ.sub("}", candidate)
+    return _TRAILING_COMMA_ARR.sub("]", cleaned)
+
+
+_INVALID = object()
+
+
+def _decode_span(candidate: str, as_is: bool = True) -> Any:
+    """
+    Decode a whole balanced span, retrying with trailing commas stripped; _INVALID if neither parses.
+    as_is=False skips the first attempt, for a span the in-place decoder has just rejected.
+    """
+    if as_is:
+        try:
+            return _decoder.decode(candidate)
+        except (json.JSONDecodeError, RecursionError):
+            pass
+    cleaned = _strip_trailing_commas(candidate)
+    if cleaned == candidate:
+        return _INVALID
+    try:
+        return _decoder.decode(cleaned)
+    except (json.JSONDecodeError, RecursionError):
+        return _INVALID
+
+
+def _first_json(text: str, open_char: str, close_char: str, accept: Callable[[Any], bool]) -> Optional[Any]:
+    """
+    Return the first top-level JSON value starting with `open_char` that parses and satisfies
+    `accept`, scanning left to right.
+    Fast path: the C decoder parses in place from the opening bracket and stops at its close,
+    ignoring any prose after it. A failed decode raises an error whose line number is counted
+    from the start of the text, so after the first failure every candidate is decoded as its own
+    balanced span instead (retried with trailing commas stripped), keeping the scan linear when
+    many small invalid spans come first; scanning resumes after each span. A bracket that never
+    closes (e.g. "{" in prose or inside a quoted phrase) is skipped, up to MAX_UNCLOSED times.
+    """
+    pos = 0
+    unclosed = 0
+    in_place = True
+    rejected = -1
+    while True:
+        start = text.find(open_char, pos)
+        if start < 0:
+            return None
+        if in_place:
+            try:
+                value, end = _decoder.raw_decode(text, start)
+            except (json.JSONDecodeError, RecursionError):
+                in_place = False
+                rejected = start
+            else:
+                if accept(value):
+                    return value
+                pos = end
+                continue
+        end = _balanced_end(text, start, open_char, close_char)
+        if end < 0:
+            unclosed += 1
+            if unclosed > MAX_UNCLOSED:
+                return None
+            pos = start + 1  # a stray bracket in prose; a real value may still follow
+            continue
+        if open_char == "{" and not _OBJECT_START.match(text, start):
+            value = _INVALID  # "{see policy}": no key or close after the brace, so not worth decoding
+        else:
+            value = _decode_span(text[start:end], as_is=start != rejected)
+        if value is _INVALID:
+            pos = end  # e.g. "{braces in prose}" before the real object
+            continue
+        if accept(value):
+            return value
+        pos = end
+
+def extract_first_json(text: str):
+    """
+    Try to find a JSON object inside the response text.
+    Returns the first complete top-level object that parses, or raises ValueError.
+    """
+    parsed = _first_json(text, "{", "}", lambda value: isinstance(value, dict))
+    if parsed is None:
+        raise ValueError("No JSON object found in model response")
+    return parsed
+
+
+def extract_first_json_array(text: str) -> List[Dict[str, Any]]:
+    """
+    Like extract_first_json, but for a top-level JSON array of objects (batched responses).
+    Bracketed prose such as "[1]" or "[see below]" is skipped. Returns a list or raises ValueError.
+    """
+    parsed = _first_json(
+        text, "[", "]", lambda value: isinstance(value, list) and all(isinstance(v, dict) for v in value)
+    )
+    if parsed is None:
+        raise ValueError("No JSON array found in model response")
+    return parsed
@@ -0,0 +1,319 @@
+import math
+import time
+import random
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class OverloadedError(Exception):
+    """Raised when the model call cannot be admitted; carries a Retry-After hint in seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Model concurrency limit reached, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit for the model call, driven by observed latency.
+    Two moving averages of successful call latency are kept: a slow one (the baseline) and a fast
+    one (recent). While recent latency stays under `tolerance` x baseline, each success grows the
+    limit by 1/limit (about +1 per window of calls); once it rises above, or a call fails, the limit
+    shrinks by `backoff`. Callers over the limit wait in a bounded queue for at most `queue_timeout`
+    seconds; beyond that they are rejected immediately with OverloadedError.
+    With adaptive=False it behaves as a fixed semaphore of `max_limit` with the same bounded queue.
+    """
+
+    def __init__(self, initial_limit: int, min_limit: int, max_limit: int, max_queue: int,
+                 queue_timeout: float, tolerance: float = 2.0, backoff: float = 0.9, adaptive: bool = True):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit) if adaptive else self.max_limit)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.adaptive = adaptive
+        self.in_flight = 0
+        self.baseline = None  # seconds, slow EWMA
+        self.recent = None    # seconds, fast EWMA
+        self._waiters: Deque["asyncio.Future"] = deque()
+        self.rejected = 0
+
+    async def acquire(self) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise OverloadedError(self.retry_after())
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()  # granted just as we gave up; hand the slot on
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise OverloadedError(self.retry_after())
+            raise
+        finally:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+
+    def release(self, latency: float, ok: Optional[bool]) -> None:
+        """
+        Return a slot, feeding the call's latency (seconds) and outcome into the limit.
+        ok=None (e.g. the caller was cancelled) returns the slot without adjusting the limit.
+        """
+        if self.adaptive and ok is not None:
+            self._update(latency, ok)
+        self._release_slot()
+
+    def _update(self, latency: float, ok: bool) -> None:
+        if ok:
+            if self.baseline is None:
+                self.baseline = self.recent = latency
+            else:
+                self.baseline += (latency - self.baseline) * 0.01
+                self.recent += (latency - self.recent) * 0.2
+        if not ok or self.recent > self.baseline * self.tolerance:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        elif self.in_flight >= int(self.limit) * 0.5:
+            # Only grow while the limit is actually being used, so idle periods do not inflate it
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _release_slot(self) -> None:
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def retry_after(self) -> int:
+        """Rough time for the queue ahead to drain, in whole seconds (at least 1)."""
+        per_call = self.baseline or 1.0
+        rounds = (len(self._waiters) + 1) / max(1, int(self.limit))
+        return max(1, math.ceil(per_call * self.tolerance * rounds))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "rejected": self.rejected,
+            "baseline_latency_ms": round(self.baseline * 1000, 1) if self.baseline is not None else None,
+            "recent_latency_ms": round(self.recent * 1000, 1) if self.recent is not None else None,
+        }
+
+
+class Hedger:
+    """
+    Hedged calls: if a call has not finished after the `percentile`-th percentile of recent call
+    latencies, a duplicate is started and whichever finishes first wins; the other is cancelled.
+    Hedges draw from a token bucket that earns `budget_ratio` tokens per call (capped at
+    `max_burst`), so hedging adds at most about budget_ratio extra calls on top of the normal load.
+    """
+
+    def __init__(self, percentile: float, budget_ratio: float, min_samples: int = 20,
+                 window: int = 512, max_burst: float = 10.0):
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.min_samples = min_samples
+        self.max_burst = max_burst
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._tokens = 0.0
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+
+    def hedge_delay(self) -> Optional[float]:
+        if len(self._latencies) < self.min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+
+    async def run(self, fn: Callable[[], Awaitable[T]]) -> T:
+        self.calls += 1
+        self._tokens = min(self.max_burst, self._tokens + self.budget_ratio)
+        delay = self.hedge_delay()
+        primary = asyncio.ensure_future(self._timed(fn))
+        tasks = {primary}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self.hedges += 1
+                        tasks.add(asyncio.ensure_future(self._timed(fn)))
+                    else:
+                        self.budget_denied += 1
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _timed(self, fn: Callable[[], Awaitable[T]]) -> T:
+        started = time.perf_counter()
+        result = await fn()
+        self._latencies.append(time.perf_counter() - started)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        delay = self.hedge_delay()
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "budget_denied": self.budget_denied,
+            "hedge_delay_ms": round(delay * 1000, 1) if delay is not None else None,
+        }
+
+
+class RetryPolicy:
+    """
+    Per-attempt and overall deadlines plus jittered retries for the model call.
+    Retries are paid from a budget that earns `budget_ratio` tokens per successful call (capped at
+    `max_budget`), so during an outage retries dry up instead of multiplying upstream load.
+    Backoff is "full jitter": a uniform delay in [0, min(max_delay, base_delay * 2**attempt)].
+    """
+
+    def __init__(self, attempt_timeout: float, total_timeout: float, max_retries: int,
+                 budget_ratio: float, is_retryable: Callable[[BaseException], bool],
+                 base_delay: float = 0.25, max_delay: float = 4.0, max_budget: float = 10.0):
+        self.attempt_timeout = attempt_timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.budget_ratio = budget_ratio
+        self.is_retryable = is_retryable
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_budget = max_budget
+        self._tokens = max_budget
+        self.attempts = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.budget_exhausted = 0
+
+    async def run(self, fn: Callable[[], Awaitable[T]]) -> T:
+        deadline = time.monotonic() + self.total_timeout
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            self.attempts += 1
+            try:
+                result = await asyncio.wait_for(fn(), min(self.attempt_timeout, max(remaining, 0.001)))
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if (attempt >= self.max_retries or not self.is_retryable(e)
+                        or time.monotonic() + delay >= deadline):
+                    raise
+                if self._tokens < 1:
+                    self.budget_exhausted += 1
+                    raise
+                self._tokens -= 1
+                self.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self._tokens = min(self.max_budget, self._tokens + self.budget_ratio)
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "budget_exhausted": self.budget_exhausted,
+            "budget_tokens": round(self._tokens, 2),
+        }
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the model while the circuit is open."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Circuit open, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker for the model backend.
+    closed: calls pass; `failure_threshold` consecutive failures open the circuit.
+    open: calls fail immediately with CircuitOpenError for `reset_timeout` seconds.
+    half_open: one probe call is let through; success closes the circuit, failure re-opens it.
+    """
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.opens = 0
+        self.rejected = 0
+
+    def before_call(self) -> None:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            else:
+                self._reject()
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                self._reject()
+            self._probe_in_flight = True
+
+    def record(self, ok: Optional[bool]) -> None:
+        """Outcome of a call admitted by before_call; None means it never reached the backend."""
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+        if ok is None:
+            return
+        if ok:
+            self.consecutive_failures = 0
+            self.state = self.CLOSED
+            return
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opens += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def _reject(self) -> None:
+        self.rejected += 1
+        remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+        raise CircuitOpenError(max(1, math.ceil(remaining)))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("uvicorn.error")
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+@dataclass
+class Camera:
+    """A polled source: `path` is an image file rewritten in place, or a directory of frames (newest wins)."""
+    id: str
+    path: str
+    mode: str = "full"
+    interval: float = 5.0       # current poll interval, adapted between min_interval and max_interval
+    min_interval: float = 1.0
+    max_interval: float = 60.0
+    priority: int = 0           # higher is served first when the model-call budget is short
+    next_due: float = 0.0
+    busy: bool = False
+    last_signature: Optional[Tuple[str, int, int]] = None
+    last_result: Optional[Dict[str, Any]] = None
+    polls: int = 0
+    analyzed: int = 0
+    unchanged: int = 0
+    deferred: int = 0
+    errors: int = 0
+    last_error: Optional[str] = field(default=None, repr=False)
+
+
+def load_cameras(path: str, min_interval: float, max_interval: float) -> List[Camera]:
+    """
+    Read a JSON list of cameras, e.g.
+    [{"id": "gate-a", "path": "/data/gate-a", "interval_s": 5, "priority": 2, "mode": "crowd"}].
+    `min_interval_s` / `max_interval_s` per camera override the global bounds.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    cameras = []
+    for entry in entries:
+        if not entry.get("id") or not entry.get("path"):
+            raise ValueError(f"Camera entry needs 'id' and 'path': {entry!r}")
+        if entry.get("mode", "full") not in ("full", "crowd", "board"):
+            raise ValueError(f"Camera {entry['id']!r}: mode must be full, crowd or board")
+        low = float(entry.get("min_interval_s", min_interval))
+        high = max(low, float(entry.get("max_interval_s", max_interval)))
+        cameras.append(Camera(
+            id=str(entry["id"]),
+            path=entry["path"],
+            mode=entry.get("mode", "full"),
+            interval=min(max(float(entry.get("interval_s", 5.0)), low), high),
+            min_interval=low,
+            max_interval=high,
+            priority=int(entry.get("priority", 0)),
+        ))
+    if len({camera.id for camera in cameras}) != len(cameras):
+        raise ValueError("Camera ids must be unique")
+    return cameras
+
+
+def latest_frame(path: str, settle_seconds: float) -> Optional[Tuple[str, int, int]]:
+    """
+    (file, mtime_ns, size) of the newest image at `path`, or None. Files modified within the last
+    `settle_seconds` are ignored, so a frame still being written is picked up on a later poll.
+    """
+    cutoff = time.time_ns() - int(settle_seconds * 1e9)
+    try:
+        if not os.path.isdir(path):
+            st = os.stat(path)
+            return (path, st.st_mtime_ns, st.st_size) if st.st_mtime_ns <= cutoff and st.st_size else None
+        newest = None
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(IMAGE_EXTENSIONS) or not entry.is_file():
+                    continue
+                st = entry.stat()
+                if st.st_size and st.st_mtime_ns <= cutoff and (newest is None or st.st_mtime_ns > newest[1]):
+                    newest = (entry.path, st.st_mtime_ns, st.st_size)
+        return newest
+    except OSError:
+        return None
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class CameraScheduler:
+    """
+    Polls cameras and feeds new frames to `analyze(camera, contents)`.
+    Every `tick` seconds, cameras that are due are checked in priority order. A frame that has not
+    changed since the last poll costs nothing; a new frame needs a token from a global budget of
+    `calls_per_minute` (bucket of `burst`). Cameras that find the budget empty stay due, so the
+    highest-priority ones get the next tokens.
+    Intervals adapt: a result that differs from the camera's previous one (crowd label, or people
+    count by `change_ratio`) halves the interval; an unchanged frame or result stretches it by
+    `backoff`, within each camera's bounds.
+    """
+
+    def __init__(self, cameras: List[Camera], analyze: Callable[[Camera, bytes], Awaitable[Dict[str, Any]]],
+                 calls_per_minute: float, burst: float = 10.0, tick: float = 0.25, backoff: float = 1.5,
+                 change_ratio: float = 0.2, settle_seconds: float = 0.2):
+        self.cameras = cameras
+        self.analyze = analyze
+        self.rate = calls_per_minute / 60
+        self.burst = max(1.0, burst)
+        self.tick = tick
+        self.backoff = backoff
+        self.change_ratio = change_ratio
+        self.settle_seconds = settle_seconds
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+        self.deferred = 0
+
+    def start(self) -> None:
+        if self.cameras:
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def stop(self) -> None:
+        tasks = [t for t in [self._task, *self._inflight] if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self._poll_due()
+            except Exception:
+                logger.exception("Camera scheduler tick failed")
+            await asyncio.sleep(self.tick)
+
+    async def _poll_due(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        due = sorted((c for c in self.cameras if not c.busy and c.next_due <= now),
+                     key=lambda c: (-c.priority, c.next_due))
+        if not due:
+            return
+        frames = await asyncio.to_thread(lambda: [latest_frame(c.path, self.settle_seconds) for c in due])
+        for camera, frame in zip(due, frames):
+            camera.polls += 1
+            if frame is None or frame == camera.last_signature:
+                camera.unchanged += 1
+                self._reschedule(camera, changed=False)
+                continue
+            if self._tokens < 1:
+                camera.deferred += 1
+                self.deferred += 1
+                continue  # still due; retried next tick, after any higher-priority camera
+            self._tokens -= 1
+            camera.busy = True
+            task = asyncio.ensure_future(self._analyze(camera, frame))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _analyze(self, camera: Camera, frame: Tuple[str, int, int]) -> None:
+        changed = False
+        try:
+            contents = await asyncio.to_thread(_read, frame[0])
+            result = await self.analyze(camera, contents)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            camera.errors += 1
+            camera.last_error = str(getattr(e, "detail", None) or e)
+        else:
+            camera.analyzed += 1
+            changed = not result.get("stale") and self._differs(camera.last_result, result)
+            camera.last_result = result
+            camera.last_error = None
+        finally:
+            camera.last_signature = frame
+            camera.busy = False
+        self._reschedule(camera, changed)
+
+    def _differs(self, previous: Optional[Dict[str, Any]], current: Dict[str, Any]) -> bool:
+        if previous is None:
+            return False
+        if previous.get("crowd_label") != current.get("crowd_label"):
+            return True
+        before, after = previous.get("people_count"), current.get("people_count")
+        if before is None or after is None:
+            return before != after
+        return abs(after - before) >= max(1, before * self.change_ratio)
+
+    def _reschedule(self, camera: Camera, changed: bool) -> None:
+        if changed:
+            camera.interval = max(camera.min_interval, camera.interval / 2)
+        else:
+            camera.interval = min(camera.max_interval, camera.interval * self.backoff)
+        camera.next_due = time.monotonic() + camera.interval
+
+    def camera_stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [
+            {
+                "id": c.id,
+                "path": c.path,
+                "mode": c.mode,
+                "priority": c.priority,
+                "interval_s": round(c.interval, 2),
+                "next_poll_in_s": round(max(0.0, c.next_due - now), 2),
+                "polls": c.polls,
+                "analyzed": c.analyzed,
+                "unchanged": c.unchanged,
+                "deferred": c.deferred,
+                "errors": c.errors,
+                "last_error": c.last_error,
+                "last_result": c.last_result,
+            }
+            for c in self.cameras
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cameras": len(self.cameras),
+            "calls_per_minute": round(self.rate * 60, 2),
+            "budget_tokens": round(self._tokens, 2),
+            "deferred": self.deferred,
+            "analyzed": sum(c.analyzed for c in self.cameras),
+            "unchanged": sum(c.unchanged for c in self.cameras),
+            "errors": sum(c.errors for c in self.cameras),
+        }
@@ -0,0 +1,96 @@
+import asyncio
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Set
+
+
+class FrameBuffer:
+    """
+    Bounded hand-off between a client pushing frames and the loop analysing them. `put` never
+    blocks: when the buffer is full the oldest frame is dropped, so a slow model call costs stale
+    frames rather than memory. capacity=1 keeps only the latest frame.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self._items: Deque[Any] = deque()
+        self._ready = asyncio.Event()
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item: Any) -> None:
+        if len(self._items) >= self.capacity:
+            self._items.popleft()
+            self.dropped += 1
+        self._items.append(item)
+        self._ready.set()
+
+    def close(self) -> None:
+        """The producer is gone: pending frames are discarded and `get` returns None."""
+        self._items.clear()
+        self._closed = True
+        self._ready.set()
+
+    async def get(self) -> Optional[Any]:
+        while not self._items:
+            if self._closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        return self._items.popleft()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class ResultBroker:
+    """
+    In-process pub/sub of results keyed by source id. Each subscriber gets its own FrameBuffer, so
+    one slow reader only loses its own oldest messages. Messages are published pre-encoded, so a
+    result is serialised once however many subscribers receive it.
+    """
+
+    def __init__(self, subscriber_buffer: int = 16):
+        self.subscriber_buffer = subscriber_buffer
+        self._topics: Dict[str, Set[FrameBuffer]] = {}
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, topic: str) -> FrameBuffer:
+        subscription = FrameBuffer(self.subscriber_buffer)
+        self._topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, topic: str, subscription: FrameBuffer) -> None:
+        subscribers = self._topics.get(topic)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._topics[topic]
+
+    def publish(self, topic: str, message: Any) -> int:
+        """Deliver to every current subscriber of `topic`; returns how many there were."""
+        self.published += 1
+        subscribers = self._topics.get(topic, ())
+        for subscription in subscribers:
+            if len(subscription) >= subscription.capacity:
+                self.dropped += 1
+            subscription.put(message)
+        self.delivered += len(subscribers)
+        return len(subscribers)
+
+    def has_subscribers(self, topic: str) -> bool:
+        return topic in self._topics
+
+    def subscriber_count(self) -> int:
+        return sum(len(subscribers) for subscribers in self._topics.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "topics": len(self._topics),
+            "subscribers": self.subscriber_count(),
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,111 @@
+import json
+from typing import Dict
+
+from fastapi import HTTPException, UploadFile, status
+
+UPLOAD_CHUNK_BYTES = 64 * 1024
+MULTIPART_OVERHEAD_BYTES = 64 * 1024  # boundaries + part headers on top of the file payload
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+class BodySizeLimitMiddleware:
+    """
+    ASGI middleware that caps request body size per path before the multipart parser buffers it.
+    Rejects with 413 up front when Content-Length is over the limit, and aborts mid-stream
+    (chunked or lying clients) as soon as the running byte count crosses it.
+    """
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        limit = self.limits.get(scope["path"])
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope.get("headers", []):
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    await _send_error(send, status.HTTP_400_BAD_REQUEST, "Invalid Content-Length header")
+                    return
+                if declared > limit:
+                    await _send_too_large(send, limit)
+                    return
+
+        received = 0
+        rejected = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    rejected = True
+                    if not response_started:
+                        await _send_too_large(send, limit)
+                    raise _BodyTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if rejected:
+                return  # 413 already sent; drop whatever the app tries to answer
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not rejected:
+                raise
+
+
+async def _send_error(send, status_code: int, detail: str):
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_too_large(send, limit: int):
+    await _send_error(send, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                      f"Request body too large. Max {limit} bytes allowed.")
+
+
+async def read_upload(file: UploadFile, max_bytes: int, chunk_size: int = UPLOAD_CHUNK_BYTES) -> bytes:
+    """
+    Read an upload in chunks, raising 413 as soon as more than `max_bytes` have been read,
+    so an oversize file is never fully copied into memory.
+    """
+    size = getattr(file, "size", None)  # known up front when the parser spooled the part
+    if size is not None and size > max_bytes:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"File too large. Max {max_bytes} bytes allowed.")
+    chunks = []
+    total = 0
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > max_bytes:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f"File too large. Max {max_bytes} bytes allowed.")
+        chunks.append(chunk)
+    return b"".join(chunks)
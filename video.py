@@ -0,0 +1,137 @@
+"""
+Frame sampling for video files, and a CLI that runs a local video through the analysis path.
+
+    python video.py terminal_cam.mp4 --fps 1 --threshold 0.03 --mode crowd > series.jsonl
+
+Frames are decoded as a stream (PyAV), one at a time, so memory does not grow with video length.
+"""
+import io
+import sys
+import json
+import asyncio
+import argparse
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, Optional, Union
+
+from PIL import Image, ImageChops, ImageStat
+
+SIGNATURE_SIZE = (64, 36)  # grayscale thumbnail compared between frames
+
+
+@dataclass
+class SampledFrame:
+    index: int           # position in the decoded stream
+    timestamp: float     # seconds from the start of the video
+    difference: Optional[float]  # vs. the last analysed frame, 0-1; None for the first one
+    data: bytes          # JPEG bytes ready for the model
+
+
+def frame_difference(a: Image.Image, b: Image.Image) -> float:
+    """Mean absolute pixel difference of two same-size grayscale signatures, scaled to 0-1."""
+    return ImageStat.Stat(ImageChops.difference(a, b)).mean[0] / 255
+
+
+class FrameSampler:
+    """
+    Decodes `source` (a path or a seekable binary file) and yields at most `sample_fps` frames per
+    second of video. A sampled frame whose difference from the last yielded frame is below
+    `scene_threshold` is skipped, so a static scene costs one model call instead of one per sample.
+    Only yielded frames are converted to full RGB and JPEG-encoded. Blocking; run in a thread.
+    """
+
+    def __init__(self, source: Union[str, BinaryIO], sample_fps: float, scene_threshold: float,
+                 max_side: int = 1536, quality: int = 85, max_frames: int = 0):
+        self.source = source
+        self.interval = 1 / sample_fps if sample_fps > 0 else 0.0
+        self.scene_threshold = scene_threshold
+        self.max_side = max_side
+        self.quality = quality
+        self.max_frames = max_frames  # 0 = no cap on yielded frames
+        self.decoded = 0
+        self.sampled = 0
+        self.skipped = 0
+        self.yielded = 0
+        self.duration: Optional[float] = None
+
+    def frames(self) -> Iterator[SampledFrame]:
+        import av  # optional dependency, only needed for video input
+
+        with av.open(self.source, mode="r") as container:
+            stream = container.streams.video[0]
+            stream.thread_type = "AUTO"
+            if stream.duration is not None and stream.time_base is not None:
+                self.duration = float(stream.duration * stream.time_base)
+            next_sample = 0.0
+            previous = None
+            for frame in container.decode(stream):
+                self.decoded += 1
+                timestamp = frame.time
+                if timestamp is None:  # no pts: derive it from the frame's position
+                    timestamp = (self.decoded - 1) / float(stream.average_rate or 1)
+                if timestamp + 1e-6 < next_sample:
+                    continue
+                next_sample = max(next_sample, timestamp) + self.interval
+                self.sampled += 1
+
+                signature = frame.reformat(width=SIGNATURE_SIZE[0], height=SIGNATURE_SIZE[1],
+                                           format="gray").to_image()
+                difference = frame_difference(previous, signature) if previous is not None else None
+                if difference is not None and difference < self.scene_threshold:
+                    self.skipped += 1
+                    continue
+                previous = signature
+
+                yield SampledFrame(self.decoded - 1, round(timestamp, 3), difference, self._encode(frame.to_image()))
+                self.yielded += 1
+                if self.max_frames and self.yielded >= self.max_frames:
+                    return
+
+    def _encode(self, img: Image.Image) -> bytes:
+        img.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, format="JPEG", quality=self.quality, optimize=True)
+        return buf.getvalue()
+
+    def stats(self) -> dict:
+        return {
+            "duration_seconds": round(self.duration, 3) if self.duration is not None else None,
+            "frames_decoded": self.decoded,
+            "frames_sampled": self.sampled,
+            "frames_skipped": self.skipped,
+            "frames_analyzed": self.yielded,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse a local video file as a time series of CrowdResult rows")
+    parser.add_argument("path", help="video file (anything FFmpeg can decode, e.g. MP4)")
+    parser.add_argument("--fps", type=float, default=None, help="frames sampled per second of video")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="min difference (0-1) from the last analysed frame; lower is skipped")
+    parser.add_argument("--max-frames", type=int, default=None, help="cap on analysed frames (0 = none)")
+    parser.add_argument("--mode", default="full", choices=["full", "crowd", "board"])
+    parser.add_argument("--user-id", help="source id, e.g. the camera the video came from")
+    parser.add_argument("--output", help="write JSON lines here instead of stdout")
+    args = parser.parse_args()
+
+    import app  # runs in-process with the server's configuration (.env, VISION_BACKEND, caches)
+
+    try:
+        report = asyncio.run(app.analyze_video(
+            args.path, mode=app.AnalysisMode(args.mode), user_id=args.user_id, sample_fps=args.fps,
+            scene_threshold=args.threshold, max_frames=args.max_frames,
+        ))
+    except app.HTTPException as e:
+        sys.exit(f"error: {e.detail}")
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for row in report["rows"]:
+            out.write(json.dumps(row) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(json.dumps(report["summary"]), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()